@@ -0,0 +1,183 @@
+"""
+Benchmark suite for the detector and gaze hot paths.
+
+Measures latency distributions (p50, p95, p99) and throughput of
+find_pupil, find_pupil_pyramid, find_glints, analyze_frame,
+DetectorContext.analyze, GazeModel.calibrate/estimate and
+PolynomialGaze.calibrate/estimate over several frame resolutions and
+calibration set sizes. Frames are rendered with synth.py so the results do
+not depend on the recordings in inputs/images.
+
+Results are written as JSON and can be compared against a saved baseline,
+in which case the program exits with status 1 if any benchmark's median
+latency got slower by more than the tolerance.
+
+Usage:
+    python bench.py --output before.json
+    python bench.py --output after.json --baseline before.json --tolerance 0.1
+"""
+
+import sys
+import json
+import platform
+import argparse
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+import detector
+import synth
+from gaze import GazeModel, PolynomialGaze
+
+
+def make_frames(width, height, n, seed=0):
+    """Render n synthetic frames looking at random screen positions.
+
+    Returns: Tuple (frames, positions).
+    """
+    rng = np.random.default_rng(seed)
+    frames, positions = [], []
+    for _ in range(n):
+        position = (rng.uniform(0, synth.SCREEN[0]), rng.uniform(0, synth.SCREEN[1]))
+        pupil = synth.pupil_for_position(position, width, height)
+        glints = synth.glints_for_pupil(pupil, width, height)
+        frames.append(synth.render_frame(pupil, glints, width, height, rng))
+        positions.append(list(position))
+    return frames, positions
+
+
+def measure(fn, args_list, repeat, warmup=3):
+    """Call fn(*args) for args cycled from args_list, repeat times after a
+    few warmup calls.
+
+    Returns: Dictionary with latency percentiles in milliseconds and the
+    throughput in calls per second.
+    """
+    for i in range(warmup):
+        fn(*args_list[i % len(args_list)])
+
+    times = np.empty(repeat)
+    for i in range(repeat):
+        args = args_list[i % len(args_list)]
+        t = perf_counter()
+        fn(*args)
+        times[i] = perf_counter() - t
+
+    ms = times * 1e3
+    return {
+        'n': repeat,
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'throughput': float(repeat / times.sum()),
+    }
+
+
+def run(resolutions, calib_sizes, repeat, calib_repeat, order=2, seed=0, backend='tree'):
+    """Run all benchmarks with the named pupil detection backend.
+
+    Returns: Dictionary mapping benchmark names to their measurements.
+    """
+    results = {}
+    for width, height in resolutions:
+        res = f'{width}x{height}'
+        frames, positions = make_frames(width, height, 16, seed)
+        pupils = [detector.find_pupil(f, debug=False, backend=backend) for f in frames]
+
+        results[f'find_pupil@{res}'] = measure(
+            lambda f: detector.find_pupil(f, debug=False, backend=backend), [(f,) for f in frames], repeat)
+        results[f'find_pupil_pyramid@{res}'] = measure(
+            lambda f: detector.find_pupil_pyramid(f, backend=backend), [(f,) for f in frames], repeat)
+        results[f'find_glints@{res}'] = measure(
+            lambda f, c: detector.find_glints(f, c, debug=False),
+            [(f, p[0]) for f, p in zip(frames, pupils)], repeat)
+        results[f'analyze_frame@{res}'] = measure(
+            lambda f: detector.analyze_frame(f, backend=backend), [(f,) for f in frames], repeat)
+        context = detector.DetectorContext(frames[0].shape, backend=backend)
+        results[f'DetectorContext.analyze@{res}'] = measure(context.analyze, [(f,) for f in frames], repeat)
+
+        for n in calib_sizes:
+            calib_frames, calib_positions = make_frames(width, height, n, seed + 1)
+            for name, make in [('GazeModel', lambda: GazeModel(calib_frames, calib_positions, backend)),
+                               ('PolynomialGaze', lambda: PolynomialGaze(calib_frames, calib_positions, order,
+                                                                         backend))]:
+                model = make()
+                results[f'{name}.calibrate@{res}/n={n}'] = measure(model.calibrate, [()], calib_repeat, warmup=1)
+                results[f'{name}.estimate@{res}/n={n}'] = measure(model.estimate, [(f,) for f in frames], repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare the median latencies of results with a baseline.
+
+    Returns: List of (name, baseline_ms, current_ms, ratio, regressed) for
+    every benchmark present in both.
+    """
+    rows = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        ratio = current['p50_ms'] / baseline[name]['p50_ms']
+        rows.append((name, baseline[name]['p50_ms'], current['p50_ms'], ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def parse_resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--resolutions', nargs='+', type=parse_resolution,
+                        default=[(320, 240), (640, 480), (1280, 960)])
+    parser.add_argument('--calib-sizes', nargs='+', type=int, default=[9, 45, 200])
+    parser.add_argument('--repeat', type=int, default=100, help='calls per frame benchmark')
+    parser.add_argument('--calib-repeat', type=int, default=5, help='calls per calibration benchmark')
+    parser.add_argument('--order', type=int, default=2, help='order of the PolynomialGaze benchmarks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='tree', choices=sorted(detector.PUPIL_BACKENDS),
+                        help='pupil detection backend')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative slowdown of the median latency')
+    args = parser.parse_args(argv)
+
+    results = run(args.resolutions, args.calib_sizes, args.repeat, args.calib_repeat,
+                  args.order, args.seed, args.backend)
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        },
+        'results': results,
+    }
+
+    for name, r in results.items():
+        print(f"{name:45s} p50 {r['p50_ms']:9.3f} ms  p95 {r['p95_ms']:9.3f} ms  "
+              f"p99 {r['p99_ms']:9.3f} ms  {r['throughput']:10.1f}/s")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        rows = compare(results, baseline, args.tolerance)
+        print()
+        for name, before, after, ratio, regressed in rows:
+            flag = 'REGRESSION' if regressed else ''
+            print(f"{name:45s} {before:9.3f} -> {after:9.3f} ms  x{ratio:5.2f} {flag}")
+        if any(r[-1] for r in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
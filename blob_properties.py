@@ -27,6 +27,11 @@ RotatedBox: Rotated rectangle as a Box2D structure.
 
 Returns: Dictionary with key equal to the property name.
 
+For all contours of a frame at once use get_properties(contours, properties),
+which computes the shared intermediates (moments, area, bounding box and arc
+length) once per contour and returns a NumPy record array with one row per
+contour. The fields of each property are listed in PROPERTY_FIELDS.
+
 Example:
     image, contours, hierarchy = cv2.findContours(image, cv2.RETR_LIST,
                                                   cv2.CHAIN_APPROX_SIMPLE)
@@ -37,6 +42,11 @@ Example:
                                                                  "convexHull"])
         if vals["area"] > 100 and vals["area"] < 200:
             goodContours.append(contour)
+
+    or vectorized over all contours:
+    props = blob_properties.get_properties(contours, ["area", "centroid"])
+    mask = (props.area > 100) & (props.area < 200)
+    goodContours = [c for c, good in zip(contours, mask) if good]
 """
 
 import cv2
@@ -157,7 +167,7 @@ def calculate_rotated_box(contour):
     """
     rectangle = cv2.minAreaRect(contour)
     box = cv2.boxPoints(rectangle)
-    return np.int0(box)
+    return box.astype(np.intp)
 
 
 def get_contour_properties(contour, properties=[]):
@@ -177,7 +187,106 @@ def get_contour_properties(contour, properties=[]):
         'length': calculate_length,
         'moments': calculate_moments,
         'perimeter': calculate_perimeter,
+        'rotatedbox': calculate_rotated_box,
     }
-    props = {k: actions[k.lower()] for k in properties}
-
-    return props
\ No newline at end of file
+    props = {k: actions[k.lower()](contour) for k in properties}
+
+    return props
+
+
+#record array fields of each property supported by get_properties
+PROPERTY_FIELDS = {
+    'approximation': [('approximation', object)],
+    'area': [('area', float)],
+    'boundingbox': [('x', int), ('y', int), ('width', int), ('height', int)],
+    'centroid': [('cx', float), ('cy', float)],
+    'circle': [('circle_x', float), ('circle_y', float), ('circle_r', float)],
+    'circularity': [('circularity', float)],
+    'convexhull': [('convexhull', object)],
+    'extend': [('extend', float)],
+    'ellipse': [('ellipse_cx', float), ('ellipse_cy', float), ('ellipse_a', float),
+                ('ellipse_b', float), ('ellipse_angle', float)],
+    'isconvex': [('isconvex', bool)],
+    'length': [('length', float)],
+    'moments': [(m, float) for m in ('m00', 'm10', 'm01', 'm20', 'm11', 'm02',
+                                     'm30', 'm21', 'm12', 'm03')],
+    'perimeter': [('perimeter', float)],
+    'rotatedbox': [('box_cx', float), ('box_cy', float), ('box_width', float),
+                   ('box_height', float), ('box_angle', float)],
+}
+
+
+def _row(contour, properties):
+    """Calculate the values of the requested properties of a contour,
+    computing each shared intermediate at most once.
+    """
+    moments = area = box = length = None
+    values = []
+    for p in properties:
+        if p in ('centroid', 'moments') and moments is None:
+            moments = cv2.moments(contour)
+        if p in ('area', 'extend', 'circularity') and area is None:
+            area = cv2.contourArea(contour)
+        if p in ('boundingbox', 'extend') and box is None:
+            box = cv2.boundingRect(contour)
+        if p in ('length', 'perimeter', 'circularity', 'approximation') and length is None:
+            length = cv2.arcLength(contour, True)
+
+        if p == 'approximation':
+            values.append(cv2.approxPolyDP(contour, 0.1 * length, True))
+        elif p == 'area':
+            values.append(area)
+        elif p == 'boundingbox':
+            values.extend(box)
+        elif p == 'centroid':
+            if moments['m00'] != 0:
+                values.extend((moments['m10'] / moments['m00'], moments['m01'] / moments['m00']))
+            else:
+                values.extend((-1.0, -1.0))
+        elif p == 'circle':
+            (x, y), r = cv2.minEnclosingCircle(contour)
+            values.extend((x, y, r))
+        elif p == 'circularity':
+            values.append(4 * math.pi * area / length ** 2 if length > 0 else 0.0)
+        elif p == 'convexhull':
+            values.append(cv2.convexHull(contour))
+        elif p == 'extend':
+            values.append(area / (box[2] * box[3]) if box[2] * box[3] > 0 else 0.0)
+        elif p == 'ellipse':
+            (x, y), (a, b), angle = calculate_ellipse(contour)
+            values.extend((x, y, a, b, angle))
+        elif p == 'isconvex':
+            values.append(cv2.isContourConvex(contour))
+        elif p in ('length', 'perimeter'):
+            values.append(length)
+        elif p == 'moments':
+            values.extend(moments[m] for m, _ in PROPERTY_FIELDS['moments'])
+        elif p == 'rotatedbox':
+            (x, y), (w, h), angle = cv2.minAreaRect(contour)
+            values.extend((x, y, w, h, angle))
+    return tuple(values)
+
+
+def get_properties(contours, properties):
+    """Calculate properties of all contours of a frame at once.
+
+    contours: the contours found by cv2.findContours().
+    properties: list of property names as for get_contour_properties.
+
+    Returns: NumPy record array with one row per contour and the fields
+    given by PROPERTY_FIELDS for each requested property.
+    """
+    props = list(dict.fromkeys(p.lower() for p in properties))
+    unknown = [p for p in props if p not in PROPERTY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown contour properties: {unknown}")
+
+    dtype = [field for p in props for field in PROPERTY_FIELDS[p]]
+    rows = [_row(c, props) for c in contours]
+    if any(t is object for _, t in dtype):
+        out = np.empty(len(rows), dtype=dtype)
+        for i, row in enumerate(rows):
+            out[i] = row
+    else:
+        out = np.array(rows, dtype=dtype)
+    return out.view(np.recarray)
\ No newline at end of file
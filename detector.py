@@ -1,73 +1,828 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
+import instrument
 from utils import *
 
 
+def load_image(img):
+    """Return img decoded with OpenCV if it is a path, otherwise unchanged.
+    """
+    if isinstance(img, str):
+        with instrument.stage('imread'):
+            return cv2.imread(img)
+    return img
+
 
+#default binary thresholds for the dark pupil and the bright glints
+PUPIL_THRESHOLD = 43
+GLINT_THRESHOLD = 210
 
-def find_pupil(img, debug=True):
-    """Detects and returns a single pupil candidate for a given image.
+NO_PUPIL = ((-1.0, -1.0), (0.0, 0.0), 0.0)
 
-    Returns: A pupil candidate in OpenCV ellipse format.
+
+def to_gray(im, out=None):
+    """Convert a BGR image to greyscale, greyscale images are returned as is.
+
+    out: optional preallocated greyscale buffer to convert into.
     """
-        
-    if isinstance(img, str):
-        im = cv2.imread(img)
-    else:
-        im = img
-    #convert color to greyscale
-    bw_im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-    
-    #converting to binary image using thresholding
-    thres_val = 43
-    ret, thres = cv2.threshold(bw_im, thres_val, 255, cv2.THRESH_BINARY_INV)
+    if im.ndim == 2:
+        return im
+    with instrument.stage('cvtColor'):
+        return cv2.cvtColor(im, cv2.COLOR_BGR2GRAY, dst=out)
+
+
+class DetectorConfig:
+    """Session level detector thresholds derived from intensity histograms.
+
+    Instead of fixed constants, the pupil and glint thresholds are derived
+    once per session from the accumulated greyscale histogram of a sample of
+    frames, and then reused for every frame. More frames can be folded into
+    the running histogram at any time with update(), which only costs one
+    histogram per added frame and recomputes the thresholds from the 256 bins.
+
+    pupil threshold: centre of the histogram valley between the darkest
+                     peak (the pupil) and the next peak (iris or skin).
+    glint threshold: the intensity above which only glint_fraction of the
+                     pixels lie, kept clear of the brightest large structure
+                     such as the sclera.
+
+    Example:
+        config = DetectorConfig.calibrate(ImageDataset('pattern0'))
+        pupil, glints = analyze_frame(frame, config=config)
+        config.save('session.json')
+    """
+
+    def __init__(self, pupil_threshold=PUPIL_THRESHOLD, glint_threshold=GLINT_THRESHOLD,
+                 glint_fraction=1e-4, decay=1.0):
+        """glint_fraction: expected fraction of glint pixels in a frame.
+        decay: factor applied to the running histogram before each update,
+               values below 1 let it follow slow lighting changes.
+        """
+        self.pupil_threshold = pupil_threshold
+        self.glint_threshold = glint_threshold
+        self.glint_fraction = glint_fraction
+        self.decay = decay
+        self.histogram = np.zeros(256)
+        self.frames = 0
+
+    @classmethod
+    def calibrate(cls, frames, sample=50, **kwargs):
+        """Create a configuration from up to sample frames evenly spread over
+        frames (a list, ImageDataset or other sequence of images or paths).
+        """
+        config = cls(**kwargs)
+        step = max(len(frames) // sample, 1)
+        config.update(frames[i] for i in range(0, len(frames), step))
+        return config
+
+    def update(self, frames):
+        """Fold the histograms of frames into the running histogram and
+        recompute the thresholds.
+        """
+        for frame in frames:
+            bw_im = to_gray(load_image(frame))
+            hist = cv2.calcHist([bw_im], [0], None, [256], [0, 256]).ravel()
+            self.histogram = self.histogram * self.decay + hist / bw_im.size
+            self.frames += 1
+        self._derive()
+
+    def _derive(self):
+        hist = self.histogram
+        if hist.sum() == 0:
+            return
+
+        #smooth out sensor noise and JPEG artefacts
+        smooth = np.convolve(hist, np.ones(5) / 5, mode='same')
+        significant = 0.005 * smooth.max()
+        peaks = [i for i in range(1, 255)
+                 if smooth[i] >= smooth[i - 1] and smooth[i] > smooth[i + 1] and smooth[i] >= significant]
 
+        #centre of the valley between the dark pupil peak and the next peak
+        if len(peaks) >= 2:
+            p, q = peaks[0], peaks[1]
+            valley = smooth[p:q + 1]
+            low = valley.min()
+            flat = np.nonzero(valley <= low + 0.05 * (min(valley[0], valley[-1]) - low))[0]
+            self.pupil_threshold = p + int((flat[0] + flat[-1]) // 2)
+
+        #brightest structure large enough to be skin or sclera, not a glint
+        large = np.nonzero(smooth >= 0.01 * smooth.max())[0]
+        bright_body = int(large.max())
+        cdf = np.cumsum(hist) / hist.sum()
+        quantile = int(np.searchsorted(cdf, 1 - self.glint_fraction))
+        self.glint_threshold = int(min(max(quantile, bright_body + 10), 250))
+
+    def thresholds(self):
+        """Return the thresholds as keyword arguments of analyze_frame.
+        """
+        return {'pupil_threshold': self.pupil_threshold, 'glint_threshold': self.glint_threshold}
+
+    def save(self, path):
+        """Save the thresholds and the running histogram as JSON.
+        """
+        with open(path, 'w') as file:
+            json.dump({
+                'pupil_threshold': self.pupil_threshold,
+                'glint_threshold': self.glint_threshold,
+                'glint_fraction': self.glint_fraction,
+                'decay': self.decay,
+                'frames': self.frames,
+                'histogram': self.histogram.tolist(),
+            }, file)
+
+    @classmethod
+    def load(cls, path):
+        """Load a configuration saved with save().
+        """
+        with open(path) as file:
+            data = json.load(file)
+        config = cls(data['pupil_threshold'], data['glint_threshold'], data['glint_fraction'],
+                     data['decay'])
+        config.frames = data['frames']
+        config.histogram = np.array(data['histogram'])
+        return config
+
+
+DEFAULT_CONFIG = DetectorConfig()
+
+
+#registry of pupil detection backends, each maps the binary pupil mask to a
+#pupil candidate in OpenCV ellipse format
+PUPIL_BACKENDS = {}
+
+
+def pupil_backend(name):
+    """Decorator registering a pupil detection backend under name.
+    """
+    def register(fn):
+        PUPIL_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+def get_pupil_backend(name):
+    """Return the pupil detection backend registered under name.
+    """
+    try:
+        return PUPIL_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown pupil backend {name!r}, choose from {sorted(PUPIL_BACKENDS)}") from None
+
+
+@pupil_backend('tree')
+def pupil_from_contour_tree(thres):
+    """Reference backend: fits the largest contour of the full contour tree.
+    """
     #find contours 
-    conts, hierarchy = cv2.findContours(thres, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    with instrument.stage('pupil.findContours'):
+        conts, hierarchy = cv2.findContours(thres, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    instrument.observe('pupil.contours', len(conts))
     if len(conts) < 1:
-        return ((-1.0, -1.0), (0.0, 0.0), 0.0)
+        return NO_PUPIL
     
     #find contour with max area
     pupil = max(conts, key=lambda c: cv2.contourArea(c))
+    #fitEllipse needs at least 5 points, a speck is not a pupil
+    if len(pupil) < 5:
+        return NO_PUPIL
     
     #fit ellipse
-    el = cv2.fitEllipse(pupil)
+    with instrument.stage('pupil.fitEllipse'):
+        el = cv2.fitEllipse(pupil)
     
     #((x, y), (a, b), angle)
     return el
-    
-    
 
-def find_glints(img, center, debug=True):
-    """Detects and returns up to four glint candidates for a given image.
+
+@pupil_backend('external')
+def pupil_from_external_contours(thres):
+    """Fits the largest outer contour, without building the hierarchy.
+    """
+    with instrument.stage('pupil.findContours'):
+        conts, _ = cv2.findContours(thres, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    instrument.observe('pupil.contours', len(conts))
+    if len(conts) < 1:
+        return NO_PUPIL
+
+    pupil = max(conts, key=cv2.contourArea)
+    if len(pupil) < 5:
+        return NO_PUPIL
+    with instrument.stage('pupil.fitEllipse'):
+        return cv2.fitEllipse(pupil)
+
+
+@pupil_backend('components')
+def pupil_from_components(thres):
+    """Picks the largest dark blob from the connected component statistics
+    and fits the ellipse on the boundary of that blob only.
+    """
+    with instrument.stage('pupil.connectedComponents'):
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(thres, connectivity=8)
+    instrument.observe('pupil.contours', n - 1)
+    if n < 2:
+        return NO_PUPIL
+
+    #label 0 is the background
+    i = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    x, y, w, h = stats[i, :4]
+    blob = (labels[y:y + h, x:x + w] == i).astype(np.uint8)
+
+    conts, _ = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y)))
+    pupil = max(conts, key=len)
+    if len(pupil) < 5:
+        return NO_PUPIL
+    with instrument.stage('pupil.fitEllipse'):
+        return cv2.fitEllipse(pupil)
+
+
+def pupil_from_gray(bw_im, thres_val=PUPIL_THRESHOLD, backend='tree', mask=None):
+    """Detects a single pupil candidate in an already greyscale image using
+    the named backend from PUPIL_BACKENDS.
+
+    mask: optional preallocated buffer of the shape of bw_im for the binary
+          pupil mask.
+
+    Returns: A pupil candidate in OpenCV ellipse format.
+    """
+    detect = get_pupil_backend(backend)
+
+    #converting to binary image using thresholding
+    with instrument.stage('pupil.threshold'):
+        ret, thres = cv2.threshold(bw_im, thres_val, 255, cv2.THRESH_BINARY_INV, dst=mask)
+
+    el = detect(thres)
+    if el[0][0] < 0:
+        instrument.count('pupil.failures')
+    return el
+
+
+def glints_from_gray(bw_im, center, thres_val=GLINT_THRESHOLD, offset=(0, 0), k=4,
+                     radius=None, min_area=1, max_area=None):
+    """Detects up to k glint candidates in an already greyscale image.
+
+    offset: position of bw_im inside the full frame, added to the returned
+            glint positions so that a crop can be searched.
+    k: maximum number of glints to return.
+    radius: only consider glints within this distance of center.
+    min_area, max_area: range of accepted glint areas in pixels.
+
+    Returns: Detected glint positions, closest to center first.
+    """
+    centroids = _nearest_glints(bw_im, center, thres_val, offset, k, radius, min_area, max_area)
+    return [tuple(c) for c in centroids.tolist()]
+
+
+def _radius_window(center, radius, shape, offset=(0, 0)):
+    """Return the bounding box (x0, y0, x1, y1) of the circle of radius
+    around center (in frame coordinates) inside an image of the given shape
+    placed at offset in the frame, empty if they do not overlap.
+    """
+    h, w = shape[:2]
+    cx, cy = center[0] - offset[0], center[1] - offset[1]
+    x0, y0 = min(max(int(cx - radius), 0), w), min(max(int(cy - radius), 0), h)
+    x1, y1 = max(min(int(cx + radius) + 1, w), x0), max(min(int(cy + radius) + 1, h), y0)
+    return x0, y0, x1, y1
+
+
+def _nearest_glints(bw_im, center, thres_val, offset, k, radius, min_area, max_area,
+                    mask=None, labels=None):
+    """glints_from_gray returning a (n, 2) array, optionally thresholding
+    into the leading part of the flat preallocated buffers mask (uint8) and
+    labels (int32) of at least the size of bw_im.
+    """
+    #only the bounding box of the search radius is thresholded and labelled
+    if radius is not None:
+        x0, y0, x1, y1 = _radius_window(center, radius, bw_im.shape, offset)
+        bw_im = bw_im[y0:y1, x0:x1]
+        offset = (offset[0] + x0, offset[1] + y0)
+        if bw_im.size == 0:
+            instrument.count('glint.missing', k)
+            return np.empty((0, 2))
+
+    h, w = bw_im.shape
+    if mask is not None:
+        mask = mask[:h * w].reshape(h, w)
+    if labels is not None:
+        labels = labels[:h * w].reshape(h, w)
+
+    #converting to binary image using thresholding
+    with instrument.stage('glint.threshold'):
+        _, thres = cv2.threshold(bw_im, thres_val, 255, cv2.THRESH_BINARY, dst=mask)
+
+    #centroids and areas of all bright blobs in one call, label 0 is background
+    with instrument.stage('glint.connectedComponents'):
+        n, _, stats, centroids = cv2.connectedComponentsWithStats(thres, labels=labels, connectivity=8)
+    instrument.observe('glint.candidates', n - 1)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    centroids = centroids[1:] + offset
+
+    keep = areas >= min_area
+    if max_area is not None:
+        keep &= areas <= max_area
+    centroids = centroids[keep]
+
+    d2 = np.sum((centroids - center) ** 2, axis=1)
+    if radius is not None:
+        centroids = centroids[d2 <= radius ** 2]
+        d2 = d2[d2 <= radius ** 2]
+
+    #partial selection of the k closest to the pupil centre
+    if len(d2) > k:
+        idx = np.argpartition(d2, k - 1)[:k]
+        centroids, d2 = centroids[idx], d2[idx]
+    if len(d2) < k:
+        instrument.count('glint.missing', k - len(d2))
+
+    return centroids[np.argsort(d2)]
+
+
+def find_pupil(img, debug=True, backend='tree', config=None):
+    """Detects and returns a single pupil candidate for a given image.
+
+    backend: name of the detection backend in PUPIL_BACKENDS.
+    config: DetectorConfig with the session thresholds, DEFAULT_CONFIG if None.
+
+    Returns: A pupil candidate in OpenCV ellipse format.
+    """
+
+    im = load_image(img)
+    #convert color to greyscale
+    bw_im = to_gray(im)
+
+    config = DEFAULT_CONFIG if config is None else config
+    return pupil_from_gray(bw_im, config.pupil_threshold, backend)
+
+
+def find_glints(img, center, debug=True, k=4, radius=None, config=None, min_area=1, max_area=None):
+    """Detects and returns up to k (four by default) glint candidates for a
+    given image, optionally only within radius of the pupil center.
+    config is a DetectorConfig with the session thresholds.
+    min_area, max_area: range of accepted glint areas in pixels.
+
+    Without radius the whole frame is thresholded and labelled, which costs
+    more than tracing the glint contours on clean frames but does not
+    degrade with the number of noise blobs. Pass a radius to only process
+    its bounding box.
 
     Returns: Detected glint positions.
     """
-    
-    if isinstance(img, str):
-        im = cv2.imread(img)
-    else:
-        im = img
+
+    im = load_image(img)
+
+    #only the bounding box of the search radius is converted
+    x0, y0 = 0, 0
+    if radius is not None:
+        x0, y0, x1, y1 = _radius_window(center, radius, im.shape)
+        im = im[y0:y1, x0:x1]
+        if im.size == 0:
+            return []
 
     #convert color to greyscale
-    bw_im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    bw_im = to_gray(im)
 
-    #converting to binary image using thresholding
-    thres_val = 210
-    _, thres = cv2.threshold(bw_im, thres_val, 255, cv2.THRESH_BINARY)
+    config = DEFAULT_CONFIG if config is None else config
+    return glints_from_gray(bw_im, center, config.glint_threshold, offset=(x0, y0), k=k, radius=radius,
+                            min_area=min_area, max_area=max_area)
 
-    #find contours 
-    conts, _ = cv2.findContours(thres, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
-    # Sort saved contours based on the distance from centre of pupil, in increasing order
-    conts.sort(key=lambda c: dist_tuple(get_center(c), center))
-    #select 4 closest
-    closest4 = conts[:4]
-    
-    #centre of closest 4
-    closest4 = [ get_center(c) for c in closest4 ]
-    
-    #return 4 closest 
-    return closest4
-    
-    
\ No newline at end of file
+def analyze_frame(img, glint_scale=1.5, debug=False, pupil_threshold=PUPIL_THRESHOLD,
+                  glint_threshold=GLINT_THRESHOLD, backend='tree', config=None):
+    """Detects the pupil and the glints of a frame in a single pass.
+
+    The frame is decoded and converted to greyscale once, and both the dark
+    pupil mask and the bright glint mask are derived from that buffer. Glints
+    are searched only in a window around the fitted pupil ellipse, whose
+    half-size is glint_scale times the major axis. If no pupil is found the
+    whole frame is searched, as in find_glints. If a DetectorConfig is given
+    its thresholds replace pupil_threshold and glint_threshold.
+
+    Returns: Tuple (pupil, glints) as returned by find_pupil and find_glints.
+    """
+    if config is not None:
+        pupil_threshold, glint_threshold = config.pupil_threshold, config.glint_threshold
+
+    im = load_image(img)
+    bw_im = to_gray(im)
+
+    pupil = pupil_from_gray(bw_im, pupil_threshold, backend)
+    (cx, cy), (a, b), _ = pupil
+    if cx < 0:
+        return pupil, glints_from_gray(bw_im, pupil[0], glint_threshold)
+
+    r = max(a, b) * glint_scale
+    h, w = bw_im.shape
+    x0, y0 = max(int(cx - r), 0), max(int(cy - r), 0)
+    x1, y1 = min(int(cx + r) + 1, w), min(int(cy + r) + 1, h)
+    glints = glints_from_gray(bw_im[y0:y1, x0:x1], pupil[0], glint_threshold, offset=(x0, y0))
+
+    return pupil, glints
+
+
+def find_pupil_pyramid(img, factor=4, scale=1.0, debug=False, backend='tree', config=None):
+    """Detects a pupil coarse-to-fine for high resolution frames.
+
+    The pupil is first located on the frame subsampled by factor, then the
+    ellipse is refitted at full resolution on a crop around the coarse
+    estimate, whose half-size is scale times the coarse major axis. Only the
+    subsampled frame and the crop are converted and thresholded, so the cost
+    grows slowly with the camera resolution. If nothing is found at the
+    coarse level the full frame is searched.
+
+    Returns: A pupil candidate in OpenCV ellipse format, in original image
+    coordinates.
+    """
+    thres_val = (DEFAULT_CONFIG if config is None else config).pupil_threshold
+    im = load_image(img)
+
+    #nearest neighbour subsampling, only every factor-th pixel is read
+    h, w = im.shape[:2]
+    small = to_gray(cv2.resize(im, (w // factor, h // factor), interpolation=cv2.INTER_NEAREST))
+    coarse = pupil_from_gray(small, thres_val, backend)
+    (cx, cy), (a, b), angle = coarse
+    if cx < 0:
+        return pupil_from_gray(to_gray(im), thres_val, backend)
+
+    #pixel centres of the subsampled image sit on multiples of factor
+    cx, cy, a, b = cx * factor, cy * factor, a * factor, b * factor
+    r = max(a, b) * scale + factor
+    x0, y0 = max(int(cx - r), 0), max(int(cy - r), 0)
+    x1, y1 = min(int(cx + r) + 1, w), min(int(cy + r) + 1, h)
+
+    fine = pupil_from_gray(to_gray(im[y0:y1, x0:x1]), thres_val, backend)
+    if fine[0][0] < 0:
+        return (cx, cy), (a, b), angle
+
+    (fx, fy), axes, angle = fine
+    return (fx + x0, fy + y0), axes, angle
+
+
+def find_pupils(images, workers=None, debug=False, backend='tree', config=None):
+    """Detects a pupil candidate for each image of a batch in parallel.
+
+    images: iterable of image paths or decoded BGR frames.
+    workers: number of threads, defaults to the number of CPU cores.
+    backend: name of the detection backend in PUPIL_BACKENDS.
+    config: DetectorConfig with the session thresholds.
+
+    Decoding, colour conversion, thresholding, contour tracing and ellipse
+    fitting all run inside OpenCV, which releases the GIL, so the work is
+    spread over a thread pool.
+
+    Returns: List of pupil candidates in OpenCV ellipse format, in input order.
+    """
+    images = list(images)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(images) <= 1:
+        return [find_pupil(im, debug, backend, config) for im in images]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(images))) as pool:
+        return list(pool.map(lambda im: find_pupil(im, debug, backend, config), images))
+
+
+class DetectorContext:
+    """Per-stream detector owning all frame sized buffers.
+
+    The greyscale image, the pupil and glint masks and the glint labels are
+    allocated once for the frame shape of the stream and OpenCV writes into
+    them on every frame. Results are written into fixed layout arrays that
+    are reused as well: pupil holds [cx, cy, a, b, angle] (cx is -1 when no
+    pupil was found) and the first n_glints rows of glints hold the glint
+    positions, closest to the pupil first, the other rows are NaN.
+
+    The returned arrays are overwritten by the next frame, copy them to keep
+    them. A context must not be shared between threads.
+
+    Example:
+        context = DetectorContext(frame.shape)
+        for frame in frames:
+            pupil, glints = context.analyze(frame)
+            center = pupil[:2]
+    """
+
+    def __init__(self, frame_shape, k=4, glint_scale=1.5, backend='tree', config=None):
+        """frame_shape: shape of the frames of the stream, colour or
+                        greyscale.
+        k: number of glint rows.
+        glint_scale: half-size of the glint search window as a multiple of
+                     the pupil major axis, as in analyze_frame.
+        backend: name of the detection backend in PUPIL_BACKENDS.
+        config: DetectorConfig with the session thresholds.
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.k = k
+        self.glint_scale = glint_scale
+        self.backend = backend
+        self.config = DEFAULT_CONFIG if config is None else config
+        get_pupil_backend(backend)
+
+        h, w = self.frame_shape[:2]
+        self.gray = np.empty((h, w), np.uint8)
+        self.pupil_mask = np.empty((h, w), np.uint8)
+        #glint windows use the leading part of flat buffers, so the crop
+        #masks stay contiguous
+        self.glint_mask = np.empty(h * w, np.uint8)
+        self.glint_labels = np.empty(h * w, np.int32)
+
+        self.pupil = np.empty(5)
+        self.glints = np.empty((k, 2))
+        self.n_glints = 0
+
+    def _gray(self, img):
+        im = load_image(img)
+        if im.shape != self.frame_shape:
+            raise ValueError(f"Frame of shape {im.shape} given to a context for {self.frame_shape}.")
+        return to_gray(im, out=self.gray)
+
+    def _pupil(self, bw_im):
+        el = pupil_from_gray(bw_im, self.config.pupil_threshold, self.backend, mask=self.pupil_mask)
+        (cx, cy), (a, b), angle = el
+        self.pupil[:] = cx, cy, a, b, angle
+        return self.pupil
+
+    def _glints(self, bw_im, center, x0=0, y0=0, radius=None):
+        centroids = _nearest_glints(bw_im, center, self.config.glint_threshold, (x0, y0), self.k,
+                                    radius, 1, None, mask=self.glint_mask, labels=self.glint_labels)
+        self.n_glints = len(centroids)
+        self.glints[:self.n_glints] = centroids
+        self.glints[self.n_glints:] = np.nan
+        return self.glints
+
+    def find_pupil(self, img):
+        """Detects the pupil of a frame of the stream.
+
+        Returns: The pupil array [cx, cy, a, b, angle].
+        """
+        return self._pupil(self._gray(img))
+
+    def find_glints(self, img, center, radius=None):
+        """Detects the glints of a frame of the stream, optionally only
+        within radius of the pupil center.
+
+        Returns: The (k, 2) glints array.
+        """
+        return self._glints(self._gray(img), center, radius=radius)
+
+    def analyze(self, img):
+        """Detects the pupil and the glints of a frame in a single pass, as
+        analyze_frame.
+
+        Returns: Tuple (pupil, glints) of the result arrays.
+        """
+        bw_im = self._gray(img)
+        pupil = self._pupil(bw_im)
+        cx, cy, a, b, _ = pupil
+        if cx < 0:
+            return pupil, self._glints(bw_im, pupil[:2])
+
+        r = max(a, b) * self.glint_scale
+        h, w = bw_im.shape
+        x0, y0 = max(int(cx - r), 0), max(int(cy - r), 0)
+        x1, y1 = min(int(cx + r) + 1, w), min(int(cy + r) + 1, h)
+        return pupil, self._glints(bw_im[y0:y1, x0:x1], pupil[:2], x0, y0)
+
+
+class PupilTracker:
+    """Stateful pupil detector for consecutive frames of a stream.
+
+    Instead of searching the full frame, only a window around the last fitted
+    ellipse is thresholded and contour traced. The window grows when the pupil
+    is not found cleanly inside it and shrinks back once tracking is stable.
+    When the pupil is lost the tracker falls back to a full frame search.
+    """
+
+    def __init__(self, scale=1.0, max_scale=4.0, growth=1.5, max_size_change=2.0, backend='tree',
+                 config=None):
+        """scale: half-size of the search window as a multiple of the major
+                  axis of the last ellipse.
+        max_scale: upper bound on the window scale before giving up and
+                   searching the full frame.
+        growth: factor by which the window grows after a miss and shrinks
+                after a hit.
+        max_size_change: largest accepted ratio between the axes of
+                         consecutive ellipses.
+        backend: name of the detection backend in PUPIL_BACKENDS.
+        config: DetectorConfig with the session thresholds.
+        """
+        self.base_scale = scale
+        self.scale = scale
+        self.max_scale = max_scale
+        self.growth = growth
+        self.max_size_change = max_size_change
+        self.backend = backend
+        self.config = config
+        self.last = None
+
+    def reset(self):
+        """Forget the last pupil so the next frame is searched in full.
+        """
+        self.last = None
+        self.scale = self.base_scale
+
+    def window(self, shape):
+        """Return the search window (x0, y0, x1, y1) around the last pupil,
+        clipped to a frame of the given shape.
+        """
+        (cx, cy), (a, b), _ = self.last
+        r = max(a, b) * self.scale
+        h, w = shape[:2]
+        x0 = max(int(cx - r), 0)
+        y0 = max(int(cy - r), 0)
+        x1 = min(int(cx + r) + 1, w)
+        y1 = min(int(cy + r) + 1, h)
+        return x0, y0, x1, y1
+
+    def _accept(self, el, width, height):
+        """Check that an ellipse found in a window of the given size lies
+        fully inside it and is of similar size as the last one.
+        """
+        (cx, cy), (a, b), _ = el
+        if cx < 0 or a <= 0 or b <= 0:
+            return False
+
+        r = max(a, b) / 2
+        if cx - r < 0 or cy - r < 0 or cx + r > width or cy + r > height:
+            return False
+
+        last_size = max(self.last[1])
+        ratio = max(a, b) / last_size if last_size > 0 else 1.0
+        return 1 / self.max_size_change <= ratio <= self.max_size_change
+
+    def track(self, img):
+        """Detects the pupil in the next frame of the stream.
+
+        Returns: A pupil candidate in OpenCV ellipse format, in full frame
+        coordinates.
+        """
+        im = load_image(img)
+
+        if self.last is not None:
+            x0, y0, x1, y1 = self.window(im.shape)
+            el = find_pupil(im[y0:y1, x0:x1], debug=False, backend=self.backend, config=self.config)
+            if self._accept(el, x1 - x0, y1 - y0):
+                (cx, cy), axes, angle = el
+                self.last = ((cx + x0, cy + y0), axes, angle)
+                self.scale = max(self.base_scale, self.scale / self.growth)
+                return self.last
+
+            #pupil not cleanly inside the window, widen it for next frame
+            self.scale = min(self.scale * self.growth, self.max_scale)
+
+        el = find_pupil(im, debug=False, backend=self.backend, config=self.config)
+        if el[0][0] < 0:
+            self.reset()
+        else:
+            self.last = el
+        return el
+
+
+class DetectionCache:
+    """Opt-in persistent cache of analyze_frame results for the images of a
+    dataset directory.
+
+    The cache is stored as a single compressed columnar .npz file in the
+    directory. Each entry is keyed by the image file name and either its
+    mtime and size or, with content_hash=True, the SHA-1 of its bytes, so an
+    entry is recomputed as soon as the image changes. The detector
+    parameters are stored with the file and the whole cache is discarded
+    when they differ from the ones in use.
+
+    Example:
+        cache = DetectionCache('inputs/images/pattern0')
+        pupil, glints = cache.analyze('inputs/images/pattern0/0.jpg')
+        cache.save()
+
+    A DetectorConfig given as config overrides pupil_threshold and
+    glint_threshold.
+    """
+
+    def __init__(self, directory, filename='detections.npz', content_hash=False,
+                 pupil_threshold=PUPIL_THRESHOLD, glint_threshold=GLINT_THRESHOLD,
+                 glint_scale=1.5, backend='tree', config=None):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self.content_hash = content_hash
+        if config is not None:
+            pupil_threshold, glint_threshold = config.pupil_threshold, config.glint_threshold
+        self.params = {
+            'pupil_threshold': pupil_threshold,
+            'glint_threshold': glint_threshold,
+            'glint_scale': glint_scale,
+            'backend': backend,
+        }
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def _params_key(self):
+        return json.dumps(dict(self.params, content_hash=self.content_hash), sort_keys=True)
+
+    def _file_key(self, path):
+        if self.content_hash:
+            with open(path, 'rb') as file:
+                return hashlib.sha1(file.read()).hexdigest()
+        st = os.stat(path)
+        return f'{st.st_mtime_ns}:{st.st_size}'
+
+    def load(self):
+        """Load the cache file, ignoring it if it is missing or was created
+        with other detector parameters.
+        """
+        self._entries = {}
+        if not os.path.exists(self.path):
+            return
+
+        with np.load(self.path, allow_pickle=False) as data:
+            if str(data['params']) != self._params_key():
+                return
+            for name, key, pupil, glints, n in zip(data['names'], data['keys'], data['pupils'],
+                                                   data['glints'], data['n_glints']):
+                cx, cy, a, b, angle = pupil.tolist()
+                gs = [tuple(g) for g in glints[:n].tolist()]
+                self._entries[str(name)] = (str(key), ((cx, cy), (a, b), angle), gs)
+
+    def save(self):
+        """Write the cache file if any entry changed since it was loaded.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            names = sorted(self._entries)
+            entries = [self._entries[name] for name in names]
+            self._dirty = False
+
+        n = len(entries)
+        pupils = np.zeros((n, 5))
+        glints = np.zeros((n, 4, 2))
+        n_glints = np.zeros(n, dtype=np.uint8)
+        for i, (_, ((cx, cy), (a, b), angle), gs) in enumerate(entries):
+            pupils[i] = cx, cy, a, b, angle
+            n_glints[i] = len(gs)
+            if gs:
+                glints[i, :len(gs)] = gs
+
+        #write next to the target and swap so readers never see a partial file
+        tmp = self.path + '.tmp.npz'
+        np.savez_compressed(tmp, params=np.array(self._params_key()),
+                            names=np.array(names, dtype=str),
+                            keys=np.array([e[0] for e in entries], dtype=str),
+                            pupils=pupils, glints=glints, n_glints=n_glints)
+        os.replace(tmp, self.path)
+
+    def analyze(self, path):
+        """Return analyze_frame(path) from the cache, running the detector
+        only if the image is new or changed.
+
+        Returns: Tuple (pupil, glints) as returned by analyze_frame.
+        """
+        name = os.path.relpath(path, self.directory)
+        key = self._file_key(path)
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1], entry[2]
+
+        self.misses += 1
+        pupil, glints = analyze_frame(path, **self.params)
+        glints = [(float(x), float(y)) for x, y in glints]
+        with self._lock:
+            self._entries[name] = (key, pupil, glints)
+            self._dirty = True
+        return pupil, glints
+
+    def analyze_many(self, paths, workers=None):
+        """Return the cached analyze_frame results of a batch of image paths,
+        detecting the missing ones on a thread pool.
+
+        Returns: List of (pupil, glints) tuples in input order.
+        """
+        paths = list(paths)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(paths) <= 1:
+            return [self.analyze(p) for p in paths]
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            return list(pool.map(self.analyze, paths))
+
+    def pupil(self, path):
+        """Return the cached pupil of an image path.
+        """
+        return self.analyze(path)[0]
+
+    def glints(self, path):
+        """Return the cached glints of an image path.
+        """
+        return self.analyze(path)[1]
@@ -3,7 +3,7 @@ import sys
 import cv2
 
 import detector
-from utils import load_json
+from utils import load_json, Prefetcher
 from record import PictureRecorder
 
 
@@ -15,6 +15,9 @@ class Tester:
         self.pupils = load_json(dataset, 'pupils')
         self.glints = load_json(dataset, 'glints')
 
+        #decoded, detected and annotated frames around the trackbar position
+        self.frames = Prefetcher(self.annotate, len(self.glints))
+
         self.title = 'Preview'
         cv2.namedWindow(self.title)
         cv2.createTrackbar('Image', self.title, 0, len(self.glints), self.change_idx)
@@ -26,15 +29,18 @@ class Tester:
 
     def loop(self):
         cv2.waitKey(0)
+        self.frames.close()
 
-    def update(self, idx):
+    def annotate(self, idx):
+        """Return image idx with the ground truth (blue) and detected (red)
+        pupil and glints drawn on it, or None if it does not exist.
+        """
         #img = cv2.imread('inputs/images/' + self.dataset + f'/{idx}.jpg')
         img = cv2.imread(os.path.join('inputs', 'images', self.dataset, f'{idx}.jpg'))
         if img is None:
-            return
+            return None
 
-        c, ax, angle = detector.find_pupil(img)
-        gs = detector.find_glints(img, c)
+        (c, ax, angle), gs = detector.analyze_frame(img)
 
         p = self.pupils[idx]
         cv2.ellipse(img, (int(p['cx']), int(p['cy'])), (int(p['ax']/2), int(p['ay']/2)), int(p['angle']), 0, 360, (255, 0, 0), 2)
@@ -48,6 +54,13 @@ class Tester:
         for g in gs:
             cv2.drawMarker(img, (int(g[0]), int(g[1])), (0, 0, 255), cv2.MARKER_CROSS, 15, 1)
 
+        return img
+
+    def update(self, idx):
+        img = self.frames.get(idx) if idx < len(self.glints) else None
+        if img is None:
+            return
+
         cv2.imshow(self.title, img)
 
         k = cv2.waitKey(1)
@@ -1,109 +1,526 @@
+import os
 import numpy as np
 import detector
+import instrument
 import cv2
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import PolynomialFeatures
 
+#version of the file layout written by RegressionGaze.save
+MODEL_FORMAT = 1
 
 
+def polynomial_exponents(order):
+    """Return the exponents (i, j) of the terms x**i * y**j of a polynomial in
+    the pupil center (x, y) up to the given order, without the constant term.
+    The terms follow the column order of sklearn's PolynomialFeatures.
+    """
+    return [(d - j, j) for d in range(1, order + 1) for j in range(d + 1)]
+
+
+def polynomial_features(centers, order, out=None):
+    """Expand pupil centers into a polynomial design matrix.
+
+    centers: (N, 2) array-like of pupil centers.
+    out: optional preallocated (N, M) array to write the features into.
+
+    Returns: (N, M) design matrix with one column per term of
+    polynomial_exponents(order).
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    exponents = polynomial_exponents(order)
+    if out is None:
+        out = np.empty((len(centers), len(exponents)))
+
+    #powers x**0 .. x**order and y**0 .. y**order, computed once
+    px = np.ones((order + 1, len(centers)))
+    py = np.ones((order + 1, len(centers)))
+    for k in range(1, order + 1):
+        np.multiply(px[k - 1], centers[:, 0], out=px[k])
+        np.multiply(py[k - 1], centers[:, 1], out=py[k])
+
+    for c, (i, j) in enumerate(exponents):
+        np.multiply(px[i], py[j], out=out[:, c])
+    return out
+
+
+def fit_least_squares(D, Y, ridge=0.0):
+    """Fit screen positions Y (N, 2) on design matrix D (N, M) with an
+    intercept, solving for both screen axes in one least squares call.
+    Without ridge this gives the same solution as one sklearn
+    LinearRegression per axis.
+
+    ridge: regularisation of the coefficients of the standardised design
+           columns, the intercept is not regularised.
+
+    Returns: Tuple (coef, intercept) with shapes (M, 2) and (2,).
+    """
+    D_mean = D.mean(axis=0)
+    Y_mean = Y.mean(axis=0)
+    if ridge == 0:
+        coef = np.linalg.lstsq(D - D_mean, Y - Y_mean, rcond=1e-6)[0]
+    else:
+        U, s, Vt, scale, filt = _centered_svd(D, ridge)
+        coef = (Vt.T * (filt / s)) @ (U.T @ (Y - Y_mean)) / scale[:, None]
+    intercept = Y_mean - D_mean @ coef
+    return coef, intercept
+
+
+def _centered_svd(D, ridge=0.0):
+    """Thin SVD of the centered design matrix, with the columns standardised
+    when ridge > 0.
+
+    Returns: Tuple (U, s, Vt, scale, filt) where scale holds the column
+    scales and filt the filter factors s**2 / (s**2 + ridge) of the singular
+    values, or 1 and 0 for the values kept and cut by lstsq without ridge.
+    """
+    Dc = D - D.mean(axis=0)
+    scale = np.ones(D.shape[1])
+    if ridge > 0:
+        scale = Dc.std(axis=0)
+        scale[scale == 0] = 1
+    U, s, Vt = np.linalg.svd(Dc / scale, full_matrices=False)
+    if ridge > 0:
+        filt = s**2 / (s**2 + ridge)
+    else:
+        filt = (s > 1e-6 * s[0]).astype(float) if len(s) else s
+    #zero singular values do not contribute either way
+    s = np.where(s > 0, s, 1)
+    return U, s, Vt, scale, filt
+
+
+def cross_validate(centers, positions, order, folds=5, ridge=0.0, seed=0, design=None):
+    """Leave-one-out and k-fold errors of a polynomial gaze model of the
+    given order, computed in closed form from the residuals and the hat
+    matrix of a single fit instead of refitting for every fold.
+
+    folds: number of folds, None to only compute the leave-one-out error.
+    ridge: regularisation as in fit_least_squares.
+    seed: seed of the random assignment of points to folds.
+    design: optional precomputed polynomial_features(centers, order).
+
+    With ridge the folds share the column scales of the full set, so the
+    errors are those of refits with that fixed standardisation.
+
+    Returns: Dictionary with the order, the number of terms and the mean
+    gaze errors 'loo' and 'kfold' in screen pixels ('kfold' is None without
+    folds, errors are inf when a held out point cannot be predicted).
+    """
+    D = polynomial_features(centers, order) if design is None else design
+    Y = np.asarray(positions, dtype=float).reshape(-1, 2)
+    n = len(Y)
+
+    #hat matrix H = A diag(w) A.T with the intercept as first column of A
+    U, s, Vt, scale, filt = _centered_svd(D, ridge)
+    keep = filt > 0
+    A = np.hstack([np.full((n, 1), 1 / np.sqrt(n)), U[:, keep]])
+    w = np.concatenate([[1.0], filt[keep]])
+
+    residuals = Y - A @ (w[:, None] * (A.T @ Y))
+    leverage = (A**2) @ w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loo = residuals / (1 - leverage)[:, None]
+    loo[leverage >= 1 - 1e-10] = np.inf
+
+    kfold = None
+    if folds is not None:
+        held_out = np.empty_like(residuals)
+        for fold in np.array_split(np.random.default_rng(seed).permutation(n), folds):
+            #(I - H_ff)^-1 e_f through the Woodbury identity
+            A_f = A[fold]
+            M = np.diag(1 / w) - A_f.T @ A_f
+            try:
+                held_out[fold] = residuals[fold] + A_f @ np.linalg.solve(M, A_f.T @ residuals[fold])
+            except np.linalg.LinAlgError:
+                held_out[fold] = np.inf
+        kfold = float(np.linalg.norm(held_out, axis=1).mean())
+
+    return {
+        'order': order,
+        'terms': D.shape[1] + 1,
+        'loo': float(np.linalg.norm(loo, axis=1).mean()),
+        'kfold': kfold,
+    }
 
-class GazeModel:
 
-    def __init__(self, calibration_images, calibration_positions):
+def select_order(centers, positions, orders, folds=5, ridge=0.0, criterion='loo', seed=0):
+    """Cross validate polynomial gaze models of several orders on the same
+    calibration points and fit the one with the lowest error.
+
+    criterion: 'loo' or 'kfold', the error used to pick the order.
+
+    Returns: Tuple (table, model) with the cross_validate results of each
+    order and a PolynomialGaze of the best order fitted on all points.
+    """
+    if criterion not in ('loo', 'kfold') or (criterion == 'kfold' and folds is None):
+        raise ValueError(f"Unknown selection criterion {criterion!r}.")
+
+    orders = sorted(orders)
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    #every order uses the leading columns of the design of the highest one
+    D = polynomial_features(centers, orders[-1])
+    table = []
+    for order in orders:
+        m = len(polynomial_exponents(order))
+        table.append(cross_validate(centers, positions, order, folds, ridge, seed, design=D[:, :m]))
+
+    best = min(table, key=lambda row: row[criterion])['order']
+    m = len(polynomial_exponents(best))
+    model = PolynomialGaze.from_centers(centers, positions, best, design=D[:, :m], ridge=ridge)
+    return table, model
+
+
+class RegressionGaze:
+    """Base class of the gaze models. Screen positions are regressed on
+    polynomial features of the detected pupil centers.
+    """
+
+    def __init__(self, calibration_images, calibration_positions, order, backend='tree', config=None):
+        self.order = order
+        self.backend = backend
+        self.config = config
         self.images = calibration_images
         self.positions = calibration_positions
+        self.centers = None
+        self.D = None
+        self.coef = None
+        self.intercept = None
         self.calibrate()
 
+    @classmethod
+    def from_centers(cls, centers, positions, order=1, design=None, backend='tree', config=None,
+                     ridge=0.0):
+        """Create a model fitted on already detected pupil centers, without
+        calibration images.
+
+        design: optional precomputed polynomial_features(centers, order).
+        ridge: regularisation as in fit_least_squares.
+        """
+        model = cls.__new__(cls)
+        model.order = order
+        model.backend = backend
+        model.config = config
+        model.images = None
+        model.positions = positions
+        model.centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        with instrument.stage('gaze.fit'):
+            model.D = polynomial_features(model.centers, order) if design is None else design
+            model.coef, model.intercept = fit_least_squares(model.D, np.asarray(positions, dtype=float),
+                                                            ridge)
+        return model
+
+    def save(self, path):
+        """Save the calibrated model to a compressed .npz file with the
+        order, the polynomial terms, the coefficients and the calibration
+        pupil centers and positions. No python objects are pickled.
+        """
+        if self.config is None:
+            config = np.empty(0)
+        else:
+            config = np.array([self.config.pupil_threshold, self.config.glint_threshold,
+                               self.config.glint_fraction, self.config.decay], dtype=float)
+        tmp = path + '.tmp.npz'
+        np.savez_compressed(tmp, format=np.array(MODEL_FORMAT), kind=np.array(type(self).__name__),
+                            order=np.array(self.order), exponents=np.array(polynomial_exponents(self.order)),
+                            coef=self.coef, intercept=self.intercept, centers=self.centers,
+                            positions=np.asarray(self.positions, dtype=float),
+                            backend=np.array(self.backend), config=config)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a model saved with save(). The model can estimate right away,
+        the calibration images are not needed. The model has the class it was
+        saved from, which must be cls or a subclass of it.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['format']) != MODEL_FORMAT:
+                raise ValueError(f"Unsupported gaze model format {int(data['format'])} in {path}.")
+            order = int(data['order'])
+            if data['exponents'].tolist() != [list(e) for e in polynomial_exponents(order)]:
+                raise ValueError(f"Polynomial terms in {path} do not match order {order}.")
+
+            #the stored class, which must be cls or one of its subclasses
+            kinds = {c.__name__: c for c in [RegressionGaze] + RegressionGaze.__subclasses__()}
+            kind = kinds.get(str(data['kind']))
+            if kind is None or not issubclass(kind, cls):
+                raise ValueError(f"{path} holds a {data['kind']}, not a {cls.__name__}.")
+
+            model = kind.__new__(kind)
+            model.order = order
+            model.backend = str(data['backend'])
+            config = data['config']
+            model.config = None if config.size == 0 else detector.DetectorConfig(
+                int(config[0]), int(config[1]), float(config[2]), float(config[3]))
+            model.images = None
+            model.positions = data['positions']
+            model.centers = data['centers']
+            model.D = polynomial_features(model.centers, order)
+            model.coef = data['coef']
+            model.intercept = data['intercept']
+        return model
+
     def calibrate(self):
-        #create an empty numpy array
-        Dx = np.empty((0,3), float)
-        Dy = np.empty((0,3), float)
-        
-        #enumerate
-        for i,im in enumerate(self.images):
-            #detect pupil in form ((x, y), (a, b), angle)
-            el = detector.find_pupil(im, debug=False)
-            #print(el)
-            center = el[0]
-            #x co-oridnate of center
-            cx = center[0]
-            #y co-oridnate of center
-            cy = center[1]            
-            #stack values to form design matrix of form [x,y,1]
-            Dx = np.vstack( (Dx, [cx, cy, 1]) )
-            Dy = np.vstack( (Dy, [cx, cy, 1]) )
-            #print(self.positions[i], '\t',center)
-        #print(Dx)
-        #print(Dy)
-        self.Dx = Dx
-        self.Dy = Dy
-        #fit the values to regression modesl
-        #from pupil centers to the positions from .json file
-        self.lrx = LinearRegression().fit(self.Dx, [ x[0] for x in self.positions])
-        self.lry = LinearRegression().fit(self.Dy, [ x[1] for x in self.positions])
+        """Detect the pupils of the calibration images and fit the model.
+        """
+        #detect pupils in form ((x, y), (a, b), angle) for all images at once
+        with instrument.stage('gaze.calibrate.detect'):
+            pupils = detector.find_pupils(self.images, debug=False, backend=self.backend, config=self.config)
+        self.centers = np.array([el[0] for el in pupils], dtype=float).reshape(-1, 2)
+        instrument.count('gaze.calibrate.failures', int(np.sum(self.centers[:, 0] < 0)))
+        self.fit(self.centers, self.positions)
+
+    def fit(self, centers, positions):
+        """Fit the model on pupil centers and the screen positions they
+        correspond to.
+        """
+        #design matrix preallocated once for all samples
+        with instrument.stage('gaze.fit'):
+            self.D = polynomial_features(centers, self.order)
+            self.coef, self.intercept = fit_least_squares(self.D, np.asarray(positions, dtype=float))
+
+    def online(self, forgetting=1.0, ridge=1e-9):
+        """Start recursive least squares recalibration from the current
+        calibration points, which can then be extended with update() and
+        removed with remove().
+
+        forgetting: factor in (0, 1] by which the weight of all earlier
+                    points is multiplied at every update, values below 1
+                    let the model follow drift.
+        ridge: regularisation of the initial inverse covariance, relative to
+               the scale of the features.
+
+        Returns: The model.
+        """
+        X = np.hstack([np.ones((len(self.centers), 1)), polynomial_features(self.centers, self.order)])
+        Y = np.asarray(self.positions, dtype=float).reshape(-1, 2)
+
+        #features are scaled to [-1, 1] to keep P well conditioned
+        scale = np.abs(X).max(axis=0)
+        scale[scale == 0] = 1
+        Xs = X / scale
+        P = np.linalg.inv(Xs.T @ Xs + ridge * np.eye(len(scale)))
+
+        self.forgetting = forgetting
+        self._scale = scale
+        self._P = P
+        #start from the calibrated coefficients so online() alone does not
+        #change the estimates
+        self._theta = np.vstack([self.intercept, self.coef]) * scale[:, None]
+        self._step = 0
+        #sample id -> (scaled features, position, step it was added at)
+        self._samples = {i: (x, y, 0) for i, (x, y) in enumerate(zip(Xs, Y))}
+        self._next_sample = len(Xs)
+        self._set_theta()
+        return self
+
+    def _set_theta(self):
+        theta = self._theta / self._scale[:, None]
+        self.intercept = theta[0]
+        self.coef = theta[1:]
+
+    def update(self, center, position):
+        """Fold a new pupil center and the screen position it corresponds to
+        into the model in constant time, starting online() with its defaults
+        if needed.
+
+        Returns: Id of the sample, to be passed to remove().
+        """
+        if getattr(self, '_P', None) is None:
+            self.online()
+
+        with instrument.stage('gaze.update'):
+            x = np.concatenate([[1.0], polynomial_features([center], self.order)[0]]) / self._scale
+            y = np.asarray(position, dtype=float)
+            lam = self.forgetting
+
+            Px = self._P @ x
+            k = Px / (lam + x @ Px)
+            self._theta += np.outer(k, y - x @ self._theta)
+            self._P = (self._P - np.outer(k, Px)) / lam
+            self._P = (self._P + self._P.T) / 2
+            self._step += 1
+            self._set_theta()
+
+        sample = self._next_sample
+        self._next_sample += 1
+        self._samples[sample] = (x, y, self._step)
+        return sample
+
+    def remove(self, sample):
+        """Remove a sample, given by the id returned by update() or the index
+        of a calibration point, from the model in constant time.
+        """
+        if getattr(self, '_P', None) is None:
+            self.online()
+
+        x, y, step = self._samples.pop(sample)
+        #weight the sample has left after the forgetting of later updates
+        w = self.forgetting ** (self._step - step)
+
+        with instrument.stage('gaze.update'):
+            Px = self._P @ x
+            denom = 1 - w * (x @ Px)
+            if denom <= 0:
+                raise ValueError("Cannot remove the last samples determining the model.")
+            self._P = self._P + w * np.outer(Px, Px) / denom
+            self._P = (self._P + self._P.T) / 2
+            self._theta -= w * np.outer(self._P @ x, y - x @ self._theta)
+            self._set_theta()
 
     def estimate(self, image):
+        """Given an input image, return the estimated gaze coordinates.
+        """
         # cv2.imshow('a', cv2.imread(image))
         # cv2.waitKey()
         #detect pupil in form ((x, y), (a, b), angle)
-        el = detector.find_pupil(image, debug=False)
-        center = el[0]
-        input = [[center[0], center[1], 1]]
-        #print(input)
+        with instrument.stage('gaze.estimate.detect'):
+            el = detector.find_pupil(image, debug=False, backend=self.backend, config=self.config)
+        if el[0][0] < 0:
+            instrument.count('gaze.estimate.failures')
+        return self.estimate_center(el[0])
+
+    def estimate_center(self, center):
+        """Return the estimated gaze coordinates for an already detected
+        pupil center.
+        """
+        with instrument.stage('gaze.predict'):
+            gaze = polynomial_features([center], self.order)[0] @ self.coef + self.intercept
         #return predicted x and y co-ordinates
-        return self.lrx.predict(input)[0], self.lry.predict(input)[0]
+        return gaze[0], gaze[1]
+
+
+    def estimate_batch(self, batch, workers=None):
+        """Return the estimated gaze coordinates of a batch of pupil centers
+        or images.
+
+        batch: (N, 2) array of pupil centers, or a sequence of image paths
+               or decoded frames whose pupils are detected in parallel.
+        workers: number of detection threads for a batch of images.
+
+        Returns: (N, 2) array of estimated gaze coordinates.
+        """
+        if isinstance(batch, np.ndarray) and batch.dtype != object and batch.ndim == 2 and batch.shape[1] == 2:
+            centers = batch
+        else:
+            batch = list(batch)
+            #images are paths or arrays of at least two dimensions, anything
+            #else (tuples, 1-D arrays) is a pupil center
+            first = batch[0] if batch else None
+            if first is not None and not (isinstance(first, str) or
+                                          (isinstance(first, np.ndarray) and first.ndim >= 2)):
+                centers = np.asarray(batch, dtype=float).reshape(-1, 2)
+            else:
+                with instrument.stage('gaze.estimate.detect'):
+                    pupils = detector.find_pupils(batch, workers, backend=self.backend, config=self.config)
+                centers = np.array([el[0] for el in pupils], dtype=float).reshape(-1, 2)
+                instrument.count('gaze.estimate.failures', int(np.sum(centers[:, 0] < 0)))
+
+        with instrument.stage('gaze.predict'):
+            return polynomial_features(centers, self.order) @ self.coef + self.intercept
+
+
+class GazeModel(RegressionGaze):
+    """Linear model for gaze estimation, i.e. a regression on the design
+    matrix [x, y, 1] of the pupil centers.
+    """
 
-class PolynomialGaze:
+    def __init__(self, calibration_images, calibration_positions, backend='tree', config=None):
+        """backend: name of the pupil detection backend in
+        detector.PUPIL_BACKENDS.
+        config: detector.DetectorConfig with the session thresholds.
+        """
+        super().__init__(calibration_images, calibration_positions, order=1, backend=backend,
+                         config=config)
+
+
+class PolynomialGaze(RegressionGaze):
     """Linear regression model for gaze estimation.
     """
-    def __init__(self, calibration_images, calibration_positions, order):
+    def __init__(self, calibration_images, calibration_positions, order, backend='tree', config=None):
         """Uses calibration_images and calibratoin_positions to
-        create regression mode.
+        create regression mode. backend names the pupil detection backend
+        in detector.PUPIL_BACKENDS and config is a detector.DetectorConfig
+        with the session thresholds.
         """
-        self.order = order
+        super().__init__(calibration_images, calibration_positions, order, backend, config)
+
+
+class CalibrationFeatures:
+    """Store of pupil centers, detected once per image path and shared between
+    models calibrated or evaluated on the same images.
+    """
+
+    def __init__(self, workers=None, cache=None, backend='tree', config=None):
+        """cache: optional detector.DetectionCache used to look up pupils
+        that were detected in an earlier run.
+        backend, config: pupil detection backend name and
+                         detector.DetectorConfig, ignored when a cache is
+                         given since the cache has its own.
+        """
+        self.workers = workers
+        self.cache = cache
+        self.backend = backend
+        self.config = config
+        self._centers = {}
+
+    def centers(self, images):
+        """Return the (N, 2) pupil centers of images, detecting only the
+        images not seen before. Decoded frames are detected every time.
+        """
+        missing = [im for im in dict.fromkeys(im for im in images if isinstance(im, str))
+                   if im not in self._centers]
+        if self.cache is not None:
+            pupils = [pupil for pupil, _ in self.cache.analyze_many(missing, self.workers)]
+        else:
+            pupils = detector.find_pupils(missing, self.workers, backend=self.backend, config=self.config)
+        for im, el in zip(missing, pupils):
+            self._centers[im] = el[0]
+
+        centers = [self._centers[im] if isinstance(im, str)
+                   else detector.find_pupil(im, debug=False, backend=self.backend, config=self.config)[0]
+                   for im in images]
+        return np.array(centers, dtype=float).reshape(-1, 2)
+
+    def center(self, image):
+        """Return the pupil center of a single image.
+        """
+        return tuple(self.centers([image])[0])
+
+
+class PolynomialFamily:
+    """Polynomial gaze models of several orders calibrated on the same images.
+
+    The pupils are detected once through a CalibrationFeatures store, and
+    every order is fitted on the leading columns of a single design matrix of
+    the highest order, since the terms are ordered by degree.
+    """
+
+    def __init__(self, calibration_images, calibration_positions, orders, features=None):
+        self.orders = sorted(orders)
+        self.features = features if features is not None else CalibrationFeatures()
         self.images = calibration_images
         self.positions = calibration_positions
-        self.Dx = None
-        self.Dy = None
-        self.model_x = None
-        self.model_y = None
-        self.calibrate()
 
-    def calibrate(self):
-        """Create the regression model here.
-        """
-        Dx = np.empty((0,2), float)
-        Dy = np.empty((0,2), float)
-        for i,im in enumerate(self.images):
-            el = detector.find_pupil(im, debug=False)
-            # print(el)
-            center = el[0]
-            cx = center[0]
-            cy = center[1]
-            Dx = np.vstack( (Dx, [cx, cy]) )
-            Dy = np.vstack( (Dy, [cx, cy]) )
-            # print(self.positions[i], '\t',center)
-        self.Dx = Dx
-        self.Dy = Dy
-        pf = PolynomialFeatures(degree=self.order)
-        X = pf.fit_transform(Dx)
-        Y = pf.fit_transform(Dy)
-        X = np.hstack( (X, np.zeros((X.shape[0], 1))) )
-        Y = np.hstack( (Y, np.zeros((Y.shape[0], 1))) )
-        # print(len(Y[0]))
-        self.model_x = LinearRegression().fit(X, [ p[0] for p in self.positions])
-        self.model_y = LinearRegression().fit(Y, [ p[1] for p in self.positions])
+        centers = self.features.centers(calibration_images)
+        D = polynomial_features(centers, self.orders[-1])
+        self.models = {}
+        for order in self.orders:
+            m = len(polynomial_exponents(order))
+            self.models[order] = PolynomialGaze.from_centers(centers, calibration_positions, order,
+                                                             design=D[:, :m],
+                                                             backend=self.features.backend,
+                                                             config=self.features.config)
+
+    def __getitem__(self, order):
+        return self.models[order]
 
     def estimate(self, image):
-        """Given an input image, return the estimated gaze coordinates.
+        """Given an input image, return a dictionary of the estimated gaze
+        coordinates of each order.
         """
-        # cv2.imshow('a', cv2.imread(image))
-        # cv2.waitKey()
-        el = detector.find_pupil(image, debug=False)
-        center = el[0]
-        input = [[center[0], center[1]]]
-        pf = PolynomialFeatures(degree=self.order)
-        input = pf.fit_transform(input)
-        input = np.hstack( (input, np.zeros((input.shape[0], 1))) )
-        return self.model_x.predict(input)[0], self.model_y.predict(input)[0]
+        return self.estimate_center(self.features.center(image))
 
+    def estimate_center(self, center):
+        """Return a dictionary of the estimated gaze coordinates of each order
+        for an already detected pupil center.
+        """
+        return {order: model.estimate_center(center) for order, model in self.models.items()}
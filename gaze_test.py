@@ -1,118 +1,205 @@
-from gaze import *
-from utils import *
-from detector import *
+"""
+Evaluation runner for the gaze model and the pupil detector.
+
+Every dataset below the root directory (a subdirectory containing a
+positions.json) is evaluated in its own process: a GazeModel is calibrated
+on the first train_size images and the remaining images are used to measure
+the gaze error against positions.json and the pupil error against
+pupils.json. The results are grouped into datasets with and without head
+movement and reported as JSON, together with per-stage wall times and the
+overall throughput.
+
+Usage:
+    python gaze_test.py inputs/images --workers 4 --output results.json
+"""
+
 import os
-import cv2
-import matplotlib.pyplot as plt
+import sys
+import json
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import utils
-
-
-gaze_error_with_movement = []
-gaze_error_without_movement = []
-pupil_error_with_movement = []
-pupil_error_without_movement = []
-
-#Load the data
-dirs = os.listdir('/home/sruthi/Desktop/IAML_GH_2021/IAML_GH_2021/inputs/images')
-print(dirs)
-
-#for each folder 
-for dir in dirs:
-    print(dir)
-    
-    #load .json file for positions 
-    pos = utils.load_json(dir,"positions")
-    #print(pos)
-    
-    #load .json file for pupils
-    pupls = utils.load_json(dir,"pupils")
-    #print(pupls)
-    
-    #load images
-    img = utils.load_images(dir)
-    #print(img)
-
-    #calculate the distance
-    #create and calibrate a GazeModel 
-    train_size = 9
-    #print(len(img))
-    model = GazeModel(img[:train_size], pos[:train_size])
-
-
-    cou = (len(img[train_size:]))
-    #print(cou)
-    
-    #estimate for non calibrated images
-    for i in range(cou):
-        #for gaze
-        x,y = model.estimate(img[train_size+i])
-        #print(x,y)
-        #calculate distance between estimated and ground truth values for gaze
-        gaze_dist = dist(pos[train_size+i],np.array([y,x]))
-        #print(gaze_dist)
-
-        #for pupil
-        #pupil ground truth values from .json
-        pupil_ground_truth_vals = pupil_json_to_opencv(pupls[train_size+i])
-        #pupil from detector.py
-        pupil_detector = find_pupil(img[train_size+i])
-        #coordinates
-        ground_truth = np.array(pupil_ground_truth_vals[0])
-        detected = np.array(pupil_detector[0])
-        #dist between ground truth and detected
-        pupil_error=dist(ground_truth,detected)
-
-        #append with and without head movement seperately
-        if(dir=="moving_medium" or dir=="moving_hard"):
-            gaze_error_with_movement.append(gaze_dist)
-            pupil_error_with_movement.append(pupil_error)
-        else:
-            gaze_error_without_movement.append(gaze_dist)
-            pupil_error_without_movement.append(pupil_error)
-
-#Data analysis
-#mean gaze error without movement
-mean_without_movement=np.mean(gaze_error_without_movement)
-print("mean error without movement:", mean_without_movement)
-#mean gaze error with movement
-mean_with_movement=np.mean(gaze_error_with_movement)
-print("mean error with movement:",mean_with_movement)        
-
-#median gaze error without movement
-median_without_movement=np.median(gaze_error_without_movement)
-print("median error without movement:", median_without_movement)
-#median gaze error with  movement
-median_with_movement=np.median(gaze_error_with_movement)
-print("median error with movement:", median_with_movement)
-
-#histogram without movement
-plt.figure("Histogram without head movement")
-plt.hist(gaze_error_without_movement, density=True, cumulative=True)
-plt.xlabel("Gaze error without movement")
-plt.ylabel("Occurrence density")
-plt.savefig("/home/sruthi/Desktop/gaze_error_without_movement.png")
-
-#histogram with movement
-plt.figure("Histogram with head movement")
-plt.hist(gaze_error_with_movement, density=True, cumulative=True)
-plt.xlabel("Gaze error with movement")
-plt.ylabel("Occurrence density")
-plt.savefig("/home/sruthi/Desktop/gaze_error_with_movement.png")
-
-#Correlation betweem pupil detection distance and gaze distance errors
-print("correlation coeff, without movement", np.corrcoef(pupil_error_without_movement, gaze_error_without_movement))
-print("correlation coeff, with movement", np.corrcoef(pupil_error_with_movement, gaze_error_with_movement))
-
-#Further analysis
-#Precision (TP/(TP+FP))
-#What proportion of positive identifications was actually correct?
-
-#Recall (TP/(TP+FN))
-#What proportion of actual positives was identified correctly?
-
-#Intersection over Union(IOU)
-
-#Average Precision(AP)
-
-#Mean Average Precision(mAP)
+
+import detector
+from gaze import GazeModel
+from utils import load_json, pupil_json_to_opencv
+
+STAGES = ['load', 'detect', 'calibrate', 'estimate']
+
+
+def list_datasets(root):
+    """Return the names of the subdirectories of root that contain a dataset.
+    """
+    return sorted(d for d in os.listdir(root)
+                  if os.path.isfile(os.path.join(root, d, 'positions.json')))
+
+
+def evaluate_dataset(root, dataset, train_size=9, threads=1, cache=False):
+    """Calibrate a GazeModel on the first train_size images of a dataset and
+    measure the errors on the remaining images.
+
+    Returns: Dictionary with the per image gaze and pupil errors of the test
+    images, the number of frames and the wall time of each stage.
+    """
+    timings = {}
+
+    t = perf_counter()
+    pos = np.array(load_json(dataset, 'positions', root=root), dtype=float)
+    pupils = load_json(dataset, 'pupils', root=root)
+    paths = [os.path.join(root, dataset, f'{i}.jpg') for i in range(len(pos))]
+    timings['load'] = perf_counter() - t
+
+    #one detection pass shared by calibration and test images
+    t = perf_counter()
+    if cache:
+        store = detector.DetectionCache(os.path.join(root, dataset))
+        detected = [p for p, _ in store.analyze_many(paths, threads)]
+        store.save()
+    else:
+        detected = detector.find_pupils(paths, workers=threads)
+    timings['detect'] = perf_counter() - t
+
+    t = perf_counter()
+    centers = np.array([el[0] for el in detected])
+    model = GazeModel.from_centers(centers[:train_size], pos[:train_size])
+    timings['calibrate'] = perf_counter() - t
+
+    t = perf_counter()
+    #gaze error between estimated and ground truth screen position
+    gaze_errors = np.linalg.norm(model.estimate_batch(centers[train_size:]) - pos[train_size:], axis=1)
+
+    #pupil error between ground truth and detected centre
+    ground_truth = np.array([pupil_json_to_opencv(p)[0] for p in pupils[train_size:]], dtype=float)
+    pupil_errors = np.linalg.norm(ground_truth.reshape(-1, 2) - centers[train_size:], axis=1)
+    timings['estimate'] = perf_counter() - t
+
+    return {
+        'dataset': dataset,
+        'frames': len(pos),
+        'gaze_errors': [float(e) for e in gaze_errors],
+        'pupil_errors': [float(e) for e in pupil_errors],
+        'timings': timings,
+    }
+
+
+def finite(value):
+    """Return value as a float, or None (null in the JSON report) if it is
+    undefined or infinite.
+    """
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def error_stats(gaze_errors, pupil_errors):
+    """Return mean, median and correlation statistics of the errors of a
+    group of datasets. The correlation is None for fewer than two errors or
+    errors without variance.
+    """
+    if not gaze_errors:
+        return {'n': 0}
+
+    corr = None
+    if len(gaze_errors) > 1 and np.std(gaze_errors) > 0 and np.std(pupil_errors) > 0:
+        corr = finite(np.corrcoef(pupil_errors, gaze_errors)[0, 1])
+
+    return {
+        'n': len(gaze_errors),
+        'gaze_mean': finite(np.mean(gaze_errors)),
+        'gaze_median': finite(np.median(gaze_errors)),
+        'pupil_mean': finite(np.mean(pupil_errors)),
+        'pupil_median': finite(np.median(pupil_errors)),
+        'correlation': corr,
+    }
+
+
+def evaluate(root, datasets=None, moving=('moving_medium', 'moving_hard'), train_size=9,
+             workers=None, cache=False):
+    """Evaluate datasets below root in a process pool.
+
+    moving: names of the datasets recorded with head movement.
+
+    Returns: Tuple (report, groups) of the JSON serializable report with
+    error statistics per group and per dataset, stage timings and throughput,
+    and the (gaze_errors, pupil_errors) lists of each group.
+    """
+    if datasets is None:
+        datasets = list_datasets(root)
+
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(evaluate_dataset, root, d, train_size, 1, cache) for d in datasets]
+        results = [f.result() for f in futures]
+    wall = perf_counter() - start
+
+    groups = {'with_movement': ([], []), 'without_movement': ([], [])}
+    for r in results:
+        gaze_errors, pupil_errors = groups['with_movement' if r['dataset'] in moving else 'without_movement']
+        gaze_errors.extend(r['gaze_errors'])
+        pupil_errors.extend(r['pupil_errors'])
+
+    frames = sum(r['frames'] for r in results)
+    report = {
+        'root': root,
+        'train_size': train_size,
+        'groups': {name: error_stats(*errors) for name, errors in groups.items()},
+        'datasets': {r['dataset']: error_stats(r['gaze_errors'], r['pupil_errors']) for r in results},
+        'stage_seconds': {s: sum(r['timings'][s] for r in results) for s in STAGES},
+        'wall_seconds': wall,
+        'frames': frames,
+        'frames_per_second': frames / wall if wall > 0 else None,
+    }
+    return report, groups
+
+
+def save_histograms(groups, directory):
+    """Save cumulative histograms of the gaze error of each group.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(directory, exist_ok=True)
+    for name, (gaze_errors, _) in groups.items():
+        if not gaze_errors:
+            continue
+        plt.figure(f"Histogram {name.replace('_', ' ')}")
+        plt.hist(gaze_errors, density=True, cumulative=True)
+        plt.xlabel(f"Gaze error {name.replace('_', ' ')}")
+        plt.ylabel("Occurrence density")
+        plt.savefig(os.path.join(directory, f'gaze_error_{name}.png'))
+        plt.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('root', nargs='?', default=os.path.join('inputs', 'images'),
+                        help='directory containing one subdirectory per dataset')
+    parser.add_argument('--datasets', nargs='+', help='datasets to evaluate, defaults to all')
+    parser.add_argument('--moving', nargs='*', default=['moving_medium', 'moving_hard'],
+                        help='datasets recorded with head movement')
+    parser.add_argument('--train-size', type=int, default=9)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--cache', action='store_true', help='use the persistent detection cache')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--plots', help='directory to save error histograms to')
+    args = parser.parse_args(argv)
+
+    report, groups = evaluate(args.root, args.datasets, set(args.moving), args.train_size,
+                              args.workers, args.cache)
+
+    if args.plots:
+        save_histograms(groups, args.plots)
+
+    #undefined statistics are None, the report must stay strict JSON
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, allow_nan=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, allow_nan=False)
+        print()
+
+
+if __name__ == '__main__':
+    main()
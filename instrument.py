@@ -0,0 +1,193 @@
+"""
+Low overhead per-stage timing and counters for the detector and gaze models.
+
+Instrumentation is disabled by default and then costs one function call per
+instrumented stage. It is enabled by setting the environment variable
+IAML_INSTRUMENT=1 (or calling enable()). If IAML_INSTRUMENT_DUMP is set to a
+file path the statistics are written there as JSON when the program exits.
+
+Durations are recorded into histograms with power-of-two microsecond
+buckets, plain values (e.g. the number of contours of a frame) into
+histograms with power-of-two buckets, and events (e.g. failed detections)
+into counters.
+
+Example:
+    with instrument.stage('threshold'):
+        _, thres = cv2.threshold(...)
+    instrument.observe('contours', len(conts))
+    instrument.count('failures')
+
+    print(json.dumps(instrument.snapshot(), indent=2))
+"""
+
+import os
+import json
+import atexit
+import threading
+from time import perf_counter_ns
+
+ENABLED = os.environ.get('IAML_INSTRUMENT', '') not in ('', '0')
+
+NB_BUCKETS = 40
+
+_lock = threading.Lock()
+_timings = {}
+_values = {}
+_counters = {}
+
+
+class Histogram:
+    """Histogram with power-of-two buckets, bucket i holds values in
+    [2**(i-1), 2**i), bucket 0 holds values below 1.
+    """
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * NB_BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[min(int(value).bit_length(), NB_BUCKETS - 1)] += 1
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket containing the q-th
+        percentile, capped by the maximum value.
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return min(2 ** i, self.max)
+        return self.max
+
+    def summary(self, scale=1.0):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total': self.total * scale,
+            'mean': self.total / self.count * scale,
+            'min': self.min * scale,
+            'max': self.max * scale,
+            'p50': self.percentile(50) * scale,
+            'p95': self.percentile(95) * scale,
+            'p99': self.percentile(99) * scale,
+        }
+
+
+class _NullStage:
+    """Context manager used when instrumentation is disabled.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed_us = (perf_counter_ns() - self.start) / 1000
+        with _lock:
+            hist = _timings.get(self.name)
+            if hist is None:
+                hist = _timings[self.name] = Histogram()
+            hist.add(elapsed_us)
+        return False
+
+
+def stage(name):
+    """Return a context manager timing the enclosed block as stage name.
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def observe(name, value):
+    """Record a value, e.g. a contour count, into the histogram name.
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        hist = _values.get(name)
+        if hist is None:
+            hist = _values[name] = Histogram()
+        hist.add(value)
+
+
+def count(name, n=1):
+    """Increment the counter name by n.
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """Discard all recorded statistics.
+    """
+    with _lock:
+        _timings.clear()
+        _values.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """Return the recorded statistics. Stage durations are in milliseconds.
+    """
+    with _lock:
+        return {
+            'timings_ms': {name: h.summary(1e-3) for name, h in sorted(_timings.items())},
+            'values': {name: h.summary() for name, h in sorted(_values.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def dump(path):
+    """Write snapshot() as JSON to path.
+    """
+    with open(path, 'w') as file:
+        json.dump(snapshot(), file, indent=2)
+
+
+if os.environ.get('IAML_INSTRUMENT_DUMP'):
+    atexit.register(dump, os.environ['IAML_INSTRUMENT_DUMP'])
@@ -0,0 +1,233 @@
+"""
+Streaming gaze estimation over a video file or capture device.
+
+The pipeline runs three stages on their own threads:
+capture:    reads frames from cv2.VideoCapture.
+detection:  finds the pupil in each frame with a detector.PupilTracker.
+estimation: maps the pupil center to screen coordinates with a gaze model.
+
+The stages are connected by bounded queues. When a queue is full the
+producer either drops the oldest queued item (drop_oldest=True, keeps the
+output close to real time) or waits for the consumer (drop_oldest=False,
+processes every frame).
+
+Example:
+    model = gaze.GazeModel(load_images('pattern0')[:9], positions[:9])
+    for frame_idx, timestamp, pupil, gaze in GazePipeline(0, model):
+        print(frame_idx, gaze)
+"""
+
+import os
+import sys
+import queue
+import threading
+import time
+
+import cv2
+
+import detector
+
+_STOP = object()
+
+
+class GazePipeline:
+
+    def __init__(self, source, model=None, queue_size=4, drop_oldest=True,
+                 tracker=None, smoother=None):
+        """source: video file path or capture device index.
+        model: calibrated GazeModel or PolynomialGaze, or None to only
+               detect pupils.
+        queue_size: capacity of each queue between two stages.
+        drop_oldest: drop the oldest queued item when a queue is full
+                     instead of blocking the producer.
+        tracker: object with a track(frame) method used for detection,
+                 defaults to a fresh detector.PupilTracker, e.g. a
+                 tracking.PredictiveTracker to skip detections.
+        smoother: object with an update(gaze, dt) method applied to the
+                  estimated gaze, e.g. a tracking.GazeSmoother, dt is the
+                  number of frames since the previous estimate.
+        """
+        self.source = source
+        self.model = model
+        self.queue_size = queue_size
+        self.drop_oldest = drop_oldest
+        self.tracker = tracker if tracker is not None else detector.PupilTracker()
+        self.smoother = smoother
+        self.dropped = {'capture': 0, 'detection': 0, 'estimation': 0}
+
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, q, item, stage):
+        """Put item on q according to the backpressure policy.
+
+        Returns: False if the pipeline was stopped while waiting.
+        """
+        while not self._stop.is_set():
+            try:
+                if self.drop_oldest:
+                    q.put_nowait(item)
+                else:
+                    q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if not self.drop_oldest:
+                    continue
+                try:
+                    q.get_nowait()
+                    self.dropped[stage] += 1
+                except queue.Empty:
+                    pass
+        return False
+
+    def _finish(self, q):
+        """Signal the end of the stream to the next stage. The marker is never
+        dropped.
+        """
+        while not self._stop.is_set():
+            try:
+                q.put(_STOP, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        """Get the next item from q, or _STOP if the pipeline was stopped.
+        """
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _stage(self, target, *args):
+        """Run a stage function, recording the first error and stopping the
+        whole pipeline if it fails.
+        """
+        try:
+            target(*args)
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+
+    def _capture(self, out):
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            raise IOError(f"Could not open video source {self.source!r}")
+
+        start = time.monotonic()
+        idx = 0
+        try:
+            while not self._stop.is_set():
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                #files carry their own clock, devices run on the wall clock
+                if isinstance(self.source, str):
+                    timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                else:
+                    timestamp = time.monotonic() - start
+                if not self._put(out, (idx, timestamp, frame), 'capture'):
+                    break
+                idx += 1
+        finally:
+            cap.release()
+        self._finish(out)
+
+    def _detect(self, inp, out):
+        while True:
+            item = self._get(inp)
+            if item is _STOP:
+                break
+            idx, timestamp, frame = item
+            pupil = self.tracker.track(frame)
+            if not self._put(out, (idx, timestamp, pupil), 'detection'):
+                break
+        self._finish(out)
+
+    def _estimate(self, inp, out):
+        last_idx = None
+        while True:
+            item = self._get(inp)
+            if item is _STOP:
+                break
+            idx, timestamp, pupil = item
+            gaze = None
+            if self.model is not None and pupil[0][0] >= 0:
+                gaze = self.model.estimate_center(pupil[0])
+                if self.smoother is not None:
+                    #dropped frames still count as elapsed time
+                    gaze = self.smoother.update(gaze, 1 if last_idx is None else idx - last_idx)
+                last_idx = idx
+            if not self._put(out, (idx, timestamp, pupil, gaze), 'estimation'):
+                break
+        self._finish(out)
+
+    def __iter__(self):
+        """Start the stages and yield (frame_idx, timestamp, pupil, gaze)
+        records as they come out of the pipeline. gaze is None for frames
+        without a detected pupil or when no model is given.
+        """
+        frames = queue.Queue(self.queue_size)
+        pupils = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size)
+
+        self._stop.clear()
+        self._error = None
+        threads = [
+            threading.Thread(target=self._stage, args=(self._capture, frames), daemon=True),
+            threading.Thread(target=self._stage, args=(self._detect, frames, pupils), daemon=True),
+            threading.Thread(target=self._stage, args=(self._estimate, pupils, results), daemon=True),
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            while True:
+                item = self._get(results)
+                if item is _STOP:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        """Stop all stages, the iterator ends after the current record.
+        """
+        self._stop.set()
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise ValueError("You must supply a video file or camera index as a program argument, "
+                         "optionally followed by a calibration data folder.")
+
+    source = sys.argv[1]
+    if source.isdigit():
+        source = int(source)
+
+    model = None
+    if len(sys.argv) > 2:
+        import gaze
+        from utils import load_json
+
+        dataset = sys.argv[2]
+        positions = load_json(dataset, 'positions')
+        images = [os.path.join('inputs', 'images', dataset, f'{i}.jpg') for i in range(9)]
+        model = gaze.GazeModel(images, positions[:9])
+
+    pipeline = GazePipeline(source, model)
+    for frame_idx, timestamp, pupil, gaze_point in pipeline:
+        print(frame_idx, f'{timestamp:.3f}', pupil[0], gaze_point)
+    print('dropped', pipeline.dropped)
+
+
+if __name__ == '__main__':
+    main()
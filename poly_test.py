@@ -1,4 +1,4 @@
-from gaze import GazeModel, PolynomialGaze
+from gaze import GazeModel, PolynomialFamily, CalibrationFeatures, select_order
 import os
 import cv2
 import utils
@@ -17,32 +17,33 @@ pos = utils.load_json(dataset, 'positions')
 min_order = 2
 max_order = 8
 nb_order = (max_order - min_order)
+orders = list(range(min_order, max_order))
+
+#pupils of every image are detected once and shared by all models
+features = CalibrationFeatures()
 for separator in [20, 25, 30, 35, 40]:
     print("separator", separator)
-    model = GazeModel(imgs[:-separator], pos[:-separator])
-    pmodel = []
-    for o in range(min_order, max_order):
-        pmodel.append(PolynomialGaze(imgs[:-separator], pos[:-separator], order=o))
+    train_centers = features.centers(imgs[:-separator])
+    model = GazeModel.from_centers(train_centers, pos[:-separator])
+    pmodel = PolynomialFamily(imgs[:-separator], pos[:-separator], orders, features=features)
 
     lr_total = 0
     pl_total = [0] * nb_order
 
-    for i in range(nb_imgs-separator, nb_imgs):
+    test_centers = features.centers(imgs[nb_imgs-separator:nb_imgs])
+    for i, center in zip(range(nb_imgs-separator, nb_imgs), test_centers):
         # print(pos[i])
-        lr_result = model.estimate(imgs[i])
+        lr_result = model.estimate_center(center)
         # print("lr_result", lr_result)
         lr_diff = utils.dist_tuple(lr_result, pos[i] )
         # print("lr_diff", lr_diff)
         lr_total += lr_diff
         # print("lr_total", lr_total)
 
-        pl_result = []
-        for o in range(nb_order):
-            r = pmodel[o].estimate(imgs[i]) 
-            pl_result.append(r)
+        pl_result = pmodel.estimate_center(center)
 
         for o in range(nb_order):
-            d = utils.dist_tuple(pl_result[o], pos[i] )
+            d = utils.dist_tuple(pl_result[orders[o]], pos[i] )
             pl_total[o] += d
             # print(i, o, pl_total[o])
 
@@ -51,3 +52,9 @@ for separator in [20, 25, 30, 35, 40]:
     for o in range(nb_order):
         print("pl order", o+2, pl_total[o])
 
+
+#closed form cross validation of all orders on every image
+table, best = select_order(features.centers(imgs), pos, [1] + orders, folds=5)
+for row in table:
+    print("order", row['order'], "loo", row['loo'], "5-fold", row['kfold'])
+print("best order", best.order)
@@ -5,10 +5,33 @@ import matplotlib.pyplot as plt
 import cv2
 import numpy as np
 import gaze
-from utils import load_json, load_images
+from utils import load_json, ImageDataset, Prefetcher
 from record import PictureRecorder
 
 
+def calibrated_model(dataset, positions, backend='tree', config=None):
+    """Return a GazeModel calibrated on the first len(positions) images of
+    dataset. The model saved in the dataset directory is reused unless the
+    positions or calibration images changed since, or it was calibrated
+    with another detector backend or thresholds.
+    """
+    images = ImageDataset(dataset)[:len(positions)]
+    model_path = os.path.join(images.path, 'gaze_model.npz')
+    sources = [os.path.join(images.path, 'positions.json')] + images.paths()
+
+    if os.path.exists(model_path) and \
+            os.path.getmtime(model_path) >= max(os.path.getmtime(p) for p in sources):
+        model = gaze.GazeModel.load(model_path)
+        thresholds = None if config is None else config.thresholds()
+        saved = None if model.config is None else model.config.thresholds()
+        if model.backend == backend and saved == thresholds:
+            return model
+
+    model = gaze.GazeModel(images, positions, backend, config)
+    model.save(model_path)
+    return model
+
+
 class PositionVisualiser:
 
     def __init__(self, dataset):
@@ -20,7 +43,19 @@ class PositionVisualiser:
         cv2.namedWindow(self.title)
         cv2.createTrackbar('Image', self.title, 0, len(self.pos), self.change_idx)
 
-        self.model = gaze.GazeModel(load_images(dataset)[:9], self.pos[:9])
+        self.model = calibrated_model(dataset, self.pos[:9])
+
+        #decoded frames and gaze estimates around the trackbar position
+        self.frames = Prefetcher(self.load, len(self.pos))
+
+        #markers of all positions are drawn once, only the current one
+        #changes between updates
+        self.markers = np.zeros((1080//4, 1920//4, 3), dtype=np.uint8)
+        for i in range(9, len(self.pos)):
+            cv2.drawMarker(self.markers, (self.pos[i][1]//4, self.pos[i][0]//4), (255, 0, 0), cv2.MARKER_CROSS, 15, 2)
+        for i in range(9):
+            cv2.drawMarker(self.markers, (self.pos[i][1]//4, self.pos[i][0]//4), (0, 255, 0), cv2.MARKER_CROSS, 15, 2)
+        self.screen = np.empty_like(self.markers)
 
         self.update(0)
 
@@ -29,40 +64,34 @@ class PositionVisualiser:
 
     def loop(self):
         cv2.waitKey(0)
+        self.frames.close()
 
-    def update(self, idx):
+    def load(self, idx):
+        """Return image idx and its estimated gaze, or None if the image does
+        not exist.
+        """
         img = cv2.imread(os.path.join(self.dataset, f'{idx}.jpg'))
         if img is None:
+            return None
+        return img, self.model.estimate(img)
+
+    def update(self, idx):
+        frame = self.frames.get(idx) if idx < len(self.pos) else None
+        if frame is None:
             return
+        img, (x, y) = frame
 
         #c, ax, angle = detector.find_pupil(img)
         #gs = detector.find_glints(img, c)
-        y, x = self.pos[idx]
-
-        screen = np.zeros((1080//4, 1920//4, 3), dtype=np.uint8)
-
-
-        for i in range(9, len(self.pos)):
-            if i == idx:
-                continue
-
-            cv2.drawMarker(screen, (self.pos[i][1]//4, self.pos[i][0]//4), (255, 0, 0), cv2.MARKER_CROSS, 15, 2)
-
-        for i in range(9):
-            if i == idx:
-                continue
-
-            cv2.drawMarker(screen, (self.pos[i][1]//4, self.pos[i][0]//4), (0, 255, 0), cv2.MARKER_CROSS, 15, 2)
-
-
-        cv2.drawMarker(screen, (x//4, y//4), (0, 0, 255), cv2.MARKER_CROSS, 15, 2)
 
-        x, y = self.model.estimate(img)
+        #the current marker is drawn over its static one with the same shape
+        np.copyto(self.screen, self.markers)
+        cv2.drawMarker(self.screen, (self.pos[idx][1]//4, self.pos[idx][0]//4), (0, 0, 255), cv2.MARKER_CROSS, 15, 2)
 
-        cv2.drawMarker(screen, (int(x)//4, int(y)//4), (0, 255, 255), cv2.MARKER_CROSS, 25, 1)
+        cv2.drawMarker(self.screen, (int(x)//4, int(y)//4), (0, 255, 255), cv2.MARKER_CROSS, 25, 1)
 
         cv2.imshow(self.title, img)
-        cv2.imshow('Screen', screen)
+        cv2.imshow('Screen', self.screen)
 
         k = cv2.waitKey(1)
 
@@ -1,16 +1,36 @@
 from abc import ABC, abstractmethod
 import cv2
 import os
+import queue
+import threading
+from itertools import count
 from glob import glob
 
+#next sequence number per (directory, file pattern), seeded by a single
+#directory scan the first time a pattern is used
+_sequence = {}
+_sequence_lock = threading.Lock()
+
+
+def next_resource_path(path, file_pattern):
+    """Return the path of the next file matching file_pattern ('*' is
+    replaced by a sequence number) in the directory path.
+    """
+    key = (os.path.abspath(path), file_pattern)
+    with _sequence_lock:
+        if key not in _sequence:
+            existing = list(glob(os.path.join(path, file_pattern)))
+            _sequence[key] = count(len(existing) + 1)
+        n = next(_sequence[key])
+
+    pat_left, pat_right = file_pattern.split('*')
+    return os.path.join(path, f'{pat_left}{n}{pat_right}')
+
+
 class Recorder(ABC):
 
     def __init__(self, path, file_pattern):
-        existing = list(glob(os.path.join(path, file_pattern)))
-        n = len(existing) + 1
-
-        pat_left, pat_right = file_pattern.split('*')
-        self.resource_path = os.path.join(path, f'pat_left{n}pat_right')
+        self.resource_path = next_resource_path(path, file_pattern)
 
 
 class VideoRecorder(Recorder):
@@ -33,4 +53,157 @@ class PictureRecorder(Recorder):
     def __init__(self, path, image):
         super().__init__(path, 'pic_*.jpg')
         print(self.resource_path)
-        cv2.imwrite(self.resource_path, image)
\ No newline at end of file
+        cv2.imwrite(self.resource_path, image)
+
+
+class AsyncWriter:
+    """Runs a handler on a background thread for items put on a bounded
+    queue, so the caller never waits for encoding or disk writes.
+
+    When the queue is full new items are dropped (block=False) or the caller
+    waits for space (block=True). The number of submitted, written, dropped
+    and failed items is kept in stats. The first exception raised by the
+    handler is kept in error and re-raised by flush() and close().
+    """
+
+    def __init__(self, handler, queue_size=64, block=False):
+        self.handler = handler
+        self.block = block
+        self.stats = {'submitted': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+        self.error = None
+
+        self._queue = queue.Queue(queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self.handler(item)
+                self.stats['written'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                if self.error is None:
+                    self.error = e
+            finally:
+                self._queue.task_done()
+
+    def submit(self, item):
+        """Queue item for the handler.
+
+        Returns: False if the item was dropped because the queue was full.
+        """
+        if self._closed:
+            raise ValueError("Cannot submit to a closed writer.")
+
+        self.stats['submitted'] += 1
+        try:
+            self._queue.put(item, block=self.block)
+            return True
+        except queue.Full:
+            self.stats['dropped'] += 1
+            return False
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        """Wait until all queued items have been handled.
+
+        Raises the first exception of the handler, if any.
+        """
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        """Handle the remaining items and stop the background thread.
+
+        Raises the first exception of the handler, if any.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+
+class AsyncVideoRecorder(VideoRecorder):
+    """VideoRecorder encoding frames on a background thread.
+
+    write() only queues the frame. Frames are copied by default so the caller
+    can reuse its buffers; pass copy=False if it does not.
+    """
+
+    def __init__(self, path, frame_shape, queue_size=64, block=False, copy=True):
+        super().__init__(path, frame_shape)
+        self.copy = copy
+        self.encoder = AsyncWriter(super().write, queue_size, block)
+
+    @property
+    def stats(self):
+        return self.encoder.stats
+
+    def write(self, frame):
+        """Queue a frame for encoding.
+
+        Returns: False if the frame was dropped because the queue was full.
+        """
+        return self.encoder.submit(frame.copy() if self.copy else frame)
+
+    def flush(self):
+        """Wait until all queued frames are encoded.
+        """
+        self.encoder.flush()
+
+    def stop(self):
+        """Encode the remaining frames and close the video file.
+        """
+        try:
+            self.encoder.close()
+        finally:
+            super().stop()
+
+    close = stop
+
+
+class AsyncPictureRecorder:
+    """Saves pictures to numbered pic_*.jpg files in path on a background
+    thread.
+    """
+
+    def __init__(self, path, queue_size=16, block=False, copy=True):
+        self.path = path
+        self.copy = copy
+        self.writer = AsyncWriter(self._write, queue_size, block)
+
+    @property
+    def stats(self):
+        return self.writer.stats
+
+    def _write(self, image):
+        #numbered when written so dropped images leave no gaps
+        path = next_resource_path(self.path, 'pic_*.jpg')
+        if not cv2.imwrite(path, image):
+            raise IOError(f"Could not write {path}")
+
+    def save(self, image):
+        """Queue an image to be written.
+
+        Returns: False if the image was dropped because the queue was full.
+        """
+        return self.writer.submit(image.copy() if self.copy else image)
+
+    def flush(self):
+        """Wait until all queued images are written.
+        """
+        self.writer.flush()
+
+    def close(self):
+        """Write the remaining images and stop the background thread.
+        """
+        self.writer.close()
@@ -0,0 +1,186 @@
+"""
+Synthetic eye image generator for scale and load testing.
+
+Renders eye frames with a dark elliptical pupil inside an iris, four bright
+glints, sensor noise, blur and an upper eyelid occluding part of the eye,
+and writes them in the dataset layout used by the rest of the project:
+
+<root>/<dataset>/{i}.jpg
+<root>/<dataset>/positions.json   screen positions [y, x] on a 1920x1080 screen
+<root>/<dataset>/pupils.json      pupil ellipses {cx, cy, ax, ay, angle}
+<root>/<dataset>/glints.json      four glint positions [x, y] per frame
+
+The pupil center depends (mildly non-linearly) on the screen position so the
+gaze models can be calibrated on the generated data.
+
+Usage:
+    python synth.py inputs/images synthetic --frames 10000 --size 3840x2160
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+SCREEN = (1080, 1920)
+
+#glint offsets from the cornea center in units of the pupil radius
+GLINT_PATTERN = [(-0.45, -0.3), (0.45, -0.3), (-0.45, 0.3), (0.45, 0.3)]
+
+
+def pupil_for_position(position, width, height):
+    """Return the pupil ellipse ((cx, cy), (ax, ay), angle) looking at a
+    screen position (y, x).
+    """
+    u = position[1] / SCREEN[1] - 0.5
+    v = position[0] / SCREEN[0] - 0.5
+    s = min(width, height)
+    cx = width / 2 + s * (0.45 * u + 0.05 * u * v)
+    cy = height / 2 + s * (0.3 * v + 0.04 * u * u)
+    #pupil is foreshortened when looking sideways
+    r = 0.065 * s
+    ax = 2 * r * (1 - 0.25 * abs(u))
+    ay = 2 * r * (1 - 0.25 * abs(v))
+    angle = float(np.degrees(np.arctan2(v, u))) % 180 if u or v else 0.0
+    return (cx, cy), (ax, ay), angle
+
+
+def glints_for_pupil(pupil, width, height):
+    """Return the four glint positions for a pupil. The glints follow the
+    cornea, which moves half as much as the pupil.
+    """
+    (cx, cy), (ax, ay), _ = pupil
+    r = max(ax, ay) / 2
+    gx = width / 2 + 0.5 * (cx - width / 2)
+    gy = height / 2 + 0.5 * (cy - height / 2)
+    return [(gx + dx * r, gy + dy * r) for dx, dy in GLINT_PATTERN]
+
+
+def render_frame(pupil, glints, width, height, rng, noise=4.0, blur=1.0, eyelid=0.0):
+    """Render a single BGR eye frame.
+
+    noise: standard deviation of the gaussian sensor noise.
+    blur: sigma of the gaussian blur, 0 disables blurring.
+    eyelid: fraction of the iris height covered by the upper eyelid.
+
+    Returns: The rendered frame as a uint8 BGR image.
+    """
+    (cx, cy), (ax, ay), angle = pupil
+    s = min(width, height)
+    frame = np.full((height, width), 150, np.float32)
+
+    #sclera, iris and pupil
+    cv2.ellipse(frame, (int(width / 2), int(height / 2)), (int(0.45 * s), int(0.3 * s)),
+                0, 0, 360, 185, -1)
+    iris_r = int(max(ax, ay) * 1.25)
+    cv2.circle(frame, (int(cx), int(cy)), iris_r, 90, -1)
+    cv2.ellipse(frame, ((cx, cy), (ax, ay), angle), 15, -1)
+
+    glint_r = max(int(0.006 * s), 1)
+    for gx, gy in glints:
+        cv2.circle(frame, (int(round(gx)), int(round(gy))), glint_r, 255, -1)
+
+    #upper eyelid coming down over the iris
+    if eyelid > 0:
+        lid = int(cy - iris_r + eyelid * 2 * iris_r)
+        pts = np.array([[0, 0], [width, 0], [width, lid], [int(cx), lid + int(0.05 * s)], [0, lid]], np.int32)
+        cv2.fillPoly(frame, [pts], 165)
+
+    if blur > 0:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur * s / 480)
+    if noise > 0:
+        frame += rng.normal(0, noise, frame.shape).astype(np.float32)
+
+    gray = np.clip(frame, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def generate(root, dataset, frames, width=640, height=480, seed=0, noise=4.0, blur=1.0,
+             max_eyelid=0.4, eyelid_prob=0.2, workers=None):
+    """Render a synthetic dataset to <root>/<dataset> with ground truth JSON.
+
+    max_eyelid: largest fraction of the iris covered by the eyelid.
+    eyelid_prob: probability of a frame having the eyelid partly closed.
+
+    Frames are rendered in bounded chunks and the ground truth is streamed
+    to the JSON files, so memory use does not grow with the number of
+    frames beyond the per-frame positions, eyelids and seeds.
+
+    Returns: Path of the dataset directory.
+    """
+    directory = os.path.join(root, dataset)
+    os.makedirs(directory, exist_ok=True)
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+
+    rng = np.random.default_rng(seed)
+    positions = np.stack([rng.integers(0, SCREEN[0], frames), rng.integers(0, SCREEN[1], frames)], axis=1)
+    eyelids = np.where(rng.random(frames) < eyelid_prob, rng.uniform(0, max_eyelid, frames), 0.0)
+    seeds = rng.integers(0, 2**32, frames)
+
+    def write(i):
+        pupil = pupil_for_position(positions[i], width, height)
+        glints = glints_for_pupil(pupil, width, height)
+        frame = render_frame(pupil, glints, width, height, np.random.default_rng(seeds[i]),
+                             noise, blur, eyelids[i])
+        cv2.imwrite(os.path.join(directory, f'{i}.jpg'), frame)
+        return pupil, glints
+
+    files = {name: open(os.path.join(directory, f'{name}.json'), 'w')
+             for name in ('positions', 'pupils', 'glints')}
+    try:
+        for file in files.values():
+            file.write('[')
+
+        #JPEG encoding releases the GIL, only a few chunks of frames are
+        #in flight at a time
+        chunk = workers * 4
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, frames, chunk):
+                indices = range(start, min(start + chunk, frames))
+                for i, (pupil, glints) in zip(indices, pool.map(write, indices)):
+                    (cx, cy), (ax, ay), angle = pupil
+                    sep = ', ' if i else ''
+                    files['positions'].write(sep + json.dumps(positions[i].tolist()))
+                    files['pupils'].write(sep + json.dumps({'cx': cx, 'cy': cy, 'ax': ax, 'ay': ay,
+                                                            'angle': angle}))
+                    files['glints'].write(sep + json.dumps([list(g) for g in glints]))
+
+        for file in files.values():
+            file.write(']')
+    finally:
+        for file in files.values():
+            file.close()
+
+    return directory
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('root', help='directory to create the dataset in, e.g. inputs/images')
+    parser.add_argument('dataset', help='name of the dataset directory')
+    parser.add_argument('--frames', type=int, default=45)
+    parser.add_argument('--size', type=parse_size, default=(640, 480), help='WIDTHxHEIGHT')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--noise', type=float, default=4.0)
+    parser.add_argument('--blur', type=float, default=1.0)
+    parser.add_argument('--max-eyelid', type=float, default=0.4)
+    parser.add_argument('--eyelid-prob', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    width, height = args.size
+    print(generate(args.root, args.dataset, args.frames, width, height, args.seed, args.noise,
+                   args.blur, args.max_eyelid, args.eyelid_prob, args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Robustness check of the stream trackers on jumping and blinking eyes.
+
+Checks two synthetic sequences, a dataset written by synth.generate, which
+jumps to a new position every frame with the eyelid partly closed on some
+frames, and a rendered sequence of fixations separated by saccades with the eye closed for a few
+frames now and then, and runs detector.PupilTracker and
+tracking.PredictiveTracker over them frame by frame. The check fails if a
+tracker raises, or if it does not recover the pupil after a saccade or
+blink (PredictiveTracker may lag up to max_k frames by design).
+
+Usage:
+    python tracker_test.py --frames 300 --size 640x480
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+import cv2
+
+import numpy as np
+
+import detector
+import synth
+import tracking
+
+
+def make_sequence(frames, width, height, seed=0, fixation=12, blink_prob=0.15, blink_frames=3):
+    """Render a sequence of fixations at random screen positions. After a
+    fixation the eye blinks with probability blink_prob.
+
+    Returns: Tuple (frames, centers, visible) with the rendered frames, the
+    true pupil centers and whether the pupil is visible in each frame.
+    """
+    rng = np.random.default_rng(seed)
+    images, centers, visible = [], [], []
+    while len(images) < frames:
+        position = (rng.uniform(0, synth.SCREEN[0]), rng.uniform(0, synth.SCREEN[1]))
+        pupil = synth.pupil_for_position(position, width, height)
+        glints = synth.glints_for_pupil(pupil, width, height)
+        for _ in range(fixation):
+            images.append(synth.render_frame(pupil, glints, width, height, rng))
+            centers.append(pupil[0])
+            visible.append(True)
+        if rng.random() < blink_prob:
+            for _ in range(blink_frames):
+                images.append(synth.render_frame(pupil, [], width, height, rng, eyelid=1.2))
+                centers.append(pupil[0])
+                visible.append(False)
+    return images[:frames], np.array(centers[:frames]), np.array(visible[:frames])
+
+
+def generated_sequence(frames, width, height, seed=0):
+    """Write a dataset with synth.generate and read it back, so the frames
+    include the JPEG artefacts of real datasets.
+
+    Returns: Tuple (frames, centers, visible) as make_sequence.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        directory = synth.generate(root, 'jumping', frames, width, height, seed)
+        images = [cv2.imread(os.path.join(directory, f'{i}.jpg')) for i in range(frames)]
+        with open(os.path.join(directory, 'pupils.json')) as file:
+            centers = np.array([(p['cx'], p['cy']) for p in json.load(file)])
+    return images, centers, np.ones(frames, bool)
+
+
+def check(tracker, frames, centers, visible, recovery=3, tolerance=3.0):
+    """Run tracker over frames.
+
+    Returns: List of error messages, empty if the tracker kept up.
+    """
+    errors = []
+    since_change = 0
+    for i, frame in enumerate(frames):
+        if i > 0 and (visible[i] != visible[i - 1] or np.any(centers[i] != centers[i - 1])):
+            since_change = 0
+        since_change += 1
+        try:
+            el = tracker.track(frame)
+        except Exception as e:
+            return errors + [f'frame {i}: {type(e).__name__}: {e}']
+
+        if not visible[i] or since_change <= recovery:
+            continue
+        if el[0][0] < 0:
+            errors.append(f'frame {i}: pupil not found')
+        elif np.hypot(*(np.array(el[0]) - centers[i])) > tolerance:
+            errors.append(f'frame {i}: center off by {np.hypot(*(np.array(el[0]) - centers[i])):.1f} px')
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--size', type=synth.parse_size, default=(640, 480), help='WIDTHxHEIGHT')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for sequence, make in [('jumping', generated_sequence), ('fixations', make_sequence)]:
+        frames, centers, visible = make(args.frames, *args.size, args.seed)
+        for name, tracker, recovery in [('PupilTracker', detector.PupilTracker(), 1),
+                                        ('PredictiveTracker', tracking.PredictiveTracker(), 9)]:
+            errors = check(tracker, frames, centers, visible, recovery)
+            print(sequence, name, 'ok' if not errors else f'{len(errors)} errors')
+            for e in errors[:10]:
+                print('  ', e)
+            failed |= bool(errors)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
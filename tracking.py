@@ -0,0 +1,253 @@
+"""
+Temporal pupil tracking that only runs the detector on some frames.
+
+A constant velocity Kalman filter over the pupil center and axes predicts
+the pupil on the frames in between detections. A detection is run every k
+frames, where k adapts to the observed pupil speed so that the pupil moves
+at most a few pixels between detections, and on the next frame whenever a
+detection disagrees with the prediction (a large normalised innovation,
+e.g. a saccade), in which case the filter restarts from the detection.
+
+PredictiveTracker has the same track(frame) method as detector.PupilTracker,
+so it can be passed as tracker to pipeline.GazePipeline. GazeSmoother
+filters the estimated gaze coordinates in the same way.
+
+Example:
+    tracker = PredictiveTracker()
+    smoother = GazeSmoother()
+    for frame in frames:
+        pupil = tracker.track(frame)
+        if pupil[0][0] >= 0:
+            gaze = smoother.update(model.estimate_center(pupil[0]))
+"""
+
+import numpy as np
+
+import detector
+import instrument
+
+
+class ConstantVelocityKalman:
+    """Kalman filter over dims values moving with a constant velocity. Time
+    is measured in frames.
+
+    The state holds the values followed by their velocities. The velocities
+    change by a white noise acceleration of variance process_noise per
+    frame, and measurements of the values have variance measurement_noise.
+    """
+
+    def __init__(self, dims, process_noise=1.0, measurement_noise=1.0):
+        self.dims = dims
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.x = None
+        self.P = None
+
+        I = np.eye(dims)
+        Z = np.zeros((dims, dims))
+        self.H = np.hstack([I, Z])
+        self.R = measurement_noise * I
+        self._I = I
+        self._Z = Z
+        self._transitions = {}
+
+    def _transition(self, dt):
+        """Return the transition matrix F and process noise Q over dt
+        frames, built once per dt.
+        """
+        if dt not in self._transitions:
+            I, Z = self._I, self._Z
+            F = np.block([[I, dt * I], [Z, I]])
+            Q = self.process_noise * np.block([[dt**4 / 4 * I, dt**3 / 2 * I],
+                                               [dt**3 / 2 * I, dt**2 * I]])
+            self._transitions[dt] = F, Q
+        return self._transitions[dt]
+
+    def reset(self, z=None):
+        """Restart the filter at the measurement z with zero velocity, or
+        without a state if z is None.
+        """
+        if z is None:
+            self.x = self.P = None
+            return
+        self.x = np.concatenate([np.asarray(z, dtype=float), np.zeros(self.dims)])
+        #the velocity is unknown until the second measurement
+        self.P = np.block([[self.R, self._Z], [self._Z, 100 * self.R]])
+
+    def predict(self, dt=1.0):
+        """Advance the state by dt frames.
+
+        Returns: The predicted values.
+        """
+        F, Q = self._transition(dt)
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+        return self.x[:self.dims]
+
+    def update(self, z):
+        """Correct the state with the measurement z.
+
+        Returns: The normalised innovation squared of z, i.e. its squared
+        Mahalanobis distance from the prediction.
+        """
+        y = np.asarray(z, dtype=float) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        S_inv = np.linalg.inv(S)
+        K = self.P @ self.H.T @ S_inv
+        self.x = self.x + K @ y
+        self.P = (np.eye(2 * self.dims) - K @ self.H) @ self.P
+        return float(y @ S_inv @ y)
+
+    @property
+    def values(self):
+        return self.x[:self.dims]
+
+    @property
+    def velocity(self):
+        return self.x[self.dims:]
+
+
+class PredictiveTracker:
+    """Pupil tracker running the detector every k-th frame and predicting
+    the pupil with a Kalman filter on the frames in between.
+    """
+
+    def __init__(self, tracker=None, min_k=1, max_k=8, max_motion=2.0, innovation_threshold=16.0,
+                 process_noise=0.5, measurement_noise=0.5, max_misses=3):
+        """tracker: object with a track(frame) method used for detection,
+                    defaults to a fresh detector.PupilTracker. If it has a
+                    last attribute, it is set to the predicted pupil before
+                    each detection so its search window follows the filter.
+        min_k, max_k: bounds of the number of frames between detections.
+        max_motion: pupil displacement in pixels allowed between detections,
+                    k is chosen so the predicted motion stays below it.
+        innovation_threshold: normalised innovation squared above which a
+                              detection does not match the prediction and
+                              the next frame is detected again.
+        process_noise, measurement_noise: variances of the Kalman filter.
+        max_misses: consecutive failed detections after which the pupil is
+                    reported lost.
+        """
+        self.tracker = tracker if tracker is not None else detector.PupilTracker()
+        self.min_k = min_k
+        self.max_k = max_k
+        self.max_motion = max_motion
+        self.innovation_threshold = innovation_threshold
+        self.max_misses = max_misses
+        self.filter = ConstantVelocityKalman(4, process_noise, measurement_noise)
+
+        self.k = min_k
+        self.angle = 0.0
+        self.detections = 0
+        self.predictions = 0
+        self._since_detection = 0
+        self._misses = 0
+
+    def reset(self):
+        """Forget the pupil so the next frame is detected from scratch.
+        """
+        self.filter.reset()
+        self.k = self.min_k
+        self._since_detection = 0
+        self._misses = 0
+        if hasattr(self.tracker, 'reset'):
+            self.tracker.reset()
+
+    def _ellipse(self):
+        cx, cy, a, b = self.filter.values
+        return (float(cx), float(cy)), (float(a), float(b)), self.angle
+
+    def _adapt(self):
+        """Choose the number of frames until the next detection from the
+        estimated pupil speed.
+        """
+        speed = float(np.hypot(*self.filter.velocity[:2]))
+        k = int(self.max_motion / speed) if speed > 0 else self.max_k
+        #grow gradually so a single quiet frame does not stretch k at once
+        self.k = max(self.min_k, min(k, self.k + 1, self.max_k))
+
+    def _detect(self, frame):
+        if self.filter.x is not None and hasattr(self.tracker, 'last'):
+            self.tracker.last = self._ellipse()
+
+        el = self.tracker.track(frame)
+        self.detections += 1
+        instrument.count('tracking.detections')
+        self._since_detection = 0
+
+        (cx, cy), (a, b), angle = el
+        if cx < 0:
+            self._misses += 1
+            self.k = self.min_k
+            if self.filter.x is None or self._misses >= self.max_misses:
+                self.reset()
+                return detector.NO_PUPIL
+            return self._ellipse()
+
+        self._misses = 0
+        self.angle = angle
+        z = (cx, cy, a, b)
+        if self.filter.x is None:
+            self.filter.reset(z)
+            self.k = self.min_k
+            return el
+
+        nis = self.filter.update(z)
+        instrument.observe('tracking.innovation', nis)
+        if nis > self.innovation_threshold:
+            #the pupil jumped, restart from the detection
+            self.filter.reset(z)
+            self.k = self.min_k
+            return el
+        self._adapt()
+        return self._ellipse()
+
+    def track(self, img):
+        """Return the pupil of the next frame of the stream, detected or
+        predicted.
+
+        Returns: A pupil candidate in OpenCV ellipse format.
+        """
+        if self.filter.x is not None:
+            self.filter.predict()
+            self._since_detection += 1
+            if self._since_detection < self.k:
+                self.predictions += 1
+                instrument.count('tracking.predictions')
+                return self._ellipse()
+
+        return self._detect(detector.load_image(img))
+
+
+class GazeSmoother:
+    """Constant velocity Kalman filter smoothing a stream of estimated gaze
+    coordinates.
+    """
+
+    def __init__(self, process_noise=10.0, measurement_noise=400.0, reset_threshold=50.0):
+        """process_noise, measurement_noise: variances of the Kalman filter
+                                             in squared screen pixels.
+        reset_threshold: normalised innovation squared above which the
+                         filter jumps to the new estimate instead of
+                         smoothing it, so saccades are not lagged.
+        """
+        self.filter = ConstantVelocityKalman(2, process_noise, measurement_noise)
+        self.reset_threshold = reset_threshold
+
+    def reset(self):
+        self.filter.reset()
+
+    def update(self, gaze, dt=1.0):
+        """Fold the gaze estimate of the next frame, dt frames after the
+        previous one, into the filter.
+
+        Returns: The smoothed gaze coordinates (x, y).
+        """
+        if self.filter.x is None:
+            self.filter.reset(gaze)
+        else:
+            self.filter.predict(dt)
+            if self.filter.update(gaze) > self.reset_threshold:
+                self.filter.reset(gaze)
+        x, y = self.filter.values
+        return float(x), float(y)
@@ -1,36 +1,242 @@
 import os
 import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
+import instrument
 from sklearn.preprocessing import PolynomialFeatures
 from sklearn import linear_model
 
 
-def load_json(directory, filename):
-    """Load json file from subdirectory in "inputs/images" with the given filename
+def load_json(directory, filename, root=os.path.join('inputs', 'images')):
+    """Load json file from subdirectory in "inputs/images" (or root) with the given filename
     - without .json extension!
 
     Returns: The json data as a dictionary or array (depending on the file).
     """
-    with open(os.path.join('inputs', 'images', directory, f'{filename}.json')) as file:
+    with open(os.path.join(root, directory, f'{filename}.json')) as file:
         return json.load(file)
 
 
-def load_images(directory):
-    """Load images from a subdirectory in "inputs/images" using OpenCV.
+def load_images(directory, root=os.path.join('inputs', 'images')):
+    """Load images from a subdirectory in "inputs/images" (or root) using OpenCV.
 
     Returns: The list of loaded images in order.
     """
-    with open(os.path.join('inputs', 'images', directory, 'positions.json')) as file:
+    with open(os.path.join(root, directory, 'positions.json')) as file:
         screen_points = json.load(file)
 
-    images = [cv2.imread(os.path.join(
-        'inputs/images', directory, f'{i}.jpg')) for i in range(len(screen_points))]
+    images = []
+    for i in range(len(screen_points)):
+        with instrument.stage('imread'):
+            images.append(cv2.imread(os.path.join(root, directory, f'{i}.jpg')))
 
     return images
 
 
+class ImageCache:
+    """Thread safe LRU cache of decoded images bounded by their total size
+    in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            im = self._items.get(key)
+            if im is not None:
+                self._items.move_to_end(key)
+            return im
+
+    def put(self, key, im):
+        size = im.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._items[key] = im
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ImageDataset:
+    """Lazy replacement for load_images over a subdirectory in "inputs/images".
+
+    Images are decoded only when accessed and kept in a LRU cache bounded by
+    cache_bytes. Slicing returns another lazy dataset sharing the same cache.
+
+    flags: cv2.imread flags, e.g. cv2.IMREAD_GRAYSCALE or
+           cv2.IMREAD_REDUCED_GRAYSCALE_2 to decode smaller images.
+    read_ahead: number of following indices decoded in the background after
+                each access, 0 disables read-ahead.
+
+    Example:
+        images = ImageDataset('pattern0', read_ahead=4)
+        calibration = images[:9]
+        first = images[0]
+    """
+
+    def __init__(self, directory, flags=cv2.IMREAD_COLOR, cache_bytes=256 * 2**20,
+                 read_ahead=0, root=os.path.join('inputs', 'images')):
+        self.directory = directory
+        self.flags = flags
+        self.read_ahead = read_ahead
+        self.path = os.path.join(root, directory)
+
+        with open(os.path.join(self.path, 'positions.json')) as file:
+            self.indices = range(len(json.load(file)))
+
+        self.cache = ImageCache(cache_bytes)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=2) if read_ahead > 0 else None
+
+    def _view(self, indices):
+        view = object.__new__(ImageDataset)
+        view.__dict__.update(self.__dict__)
+        view.indices = indices
+        return view
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self._view(self.indices[idx])
+
+        i = self.indices[idx]
+        im = self._load(i)
+        if self._pool is not None:
+            pos = idx % len(self)
+            self._prefetch(self.indices[pos + 1:pos + 1 + self.read_ahead])
+        return im
+
+    def image_path(self, i):
+        """Return the path of image i of the underlying directory.
+        """
+        return os.path.join(self.path, f'{i}.jpg')
+
+    def paths(self):
+        """Return the image paths of this dataset (view) in order.
+        """
+        return [self.image_path(i) for i in self.indices]
+
+    def _decode(self, i):
+        im = self.cache.get(i)
+        if im is None:
+            with instrument.stage('imread'):
+                im = cv2.imread(self.image_path(i), self.flags)
+            if im is not None:
+                self.cache.put(i, im)
+        with self._lock:
+            self._pending.pop(i, None)
+        return im
+
+    def _load(self, i):
+        im = self.cache.get(i)
+        if im is not None:
+            return im
+        with self._lock:
+            future = self._pending.get(i)
+        if future is not None:
+            return future.result()
+        return self._decode(i)
+
+    def _prefetch(self, indices):
+        with self._lock:
+            for i in indices:
+                if i not in self._pending and i not in self.cache:
+                    self._pending[i] = self._pool.submit(self._decode, i)
+
+
+class Prefetcher:
+    """Computes fn(idx) ahead of a cursor moving over indices 0..length-1.
+
+    After every get(idx) the neighbouring indices (ahead after and behind
+    before idx) are computed on a background thread pool. Results are kept in
+    a LRU cache of cache_size entries, so moving back and forth over recent
+    indices costs nothing.
+    """
+
+    def __init__(self, fn, length, ahead=4, behind=2, cache_size=64, workers=2):
+        self.fn = fn
+        self.length = length
+        self.ahead = ahead
+        self.behind = behind
+        self.cache_size = max(cache_size, ahead + behind + 1)
+
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _store(self, idx, result):
+        with self._lock:
+            self._cache[idx] = result
+            self._cache.move_to_end(idx)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self._pending.pop(idx, None)
+
+    def _compute(self, idx):
+        result = self.fn(idx)
+        self._store(idx, result)
+        return result
+
+    def get(self, idx):
+        """Return fn(idx), from the cache if possible, and start computing
+        the neighbours of idx in the background.
+        """
+        with self._lock:
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                result, future = self._cache[idx], None
+            else:
+                result, future = None, self._pending.get(idx)
+                if future is None:
+                    future = self._pending[idx] = self._pool.submit(self._compute, idx)
+
+        if future is not None:
+            result = future.result()
+
+        self._schedule(idx)
+        return result
+
+    def _schedule(self, idx):
+        neighbours = list(range(idx + 1, idx + 1 + self.ahead)) + list(range(idx - 1, idx - 1 - self.behind, -1))
+        with self._lock:
+            for j in neighbours:
+                if 0 <= j < self.length and j not in self._cache and j not in self._pending:
+                    self._pending[j] = self._pool.submit(self._compute, j)
+
+    def close(self):
+        """Stop the background threads, dropping queued work.
+        """
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
 def dist(a, b):
     """Calculate the euclidean distance from a to b.
     """
@@ -57,7 +263,7 @@ def get_center(cnt):
     """Return the center of mass of a polyline
     """
     # source: https://www.pyimagesearch.com/2016/02/01/opencv-center-of-contour/
-    if len(cnt[0][0] == 1):
+    if len(cnt) == 1:
         return tuple(cnt[0][0])
     M = cv2.moments(cnt)
     cX = M["m10"] / M["m00"]